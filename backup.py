@@ -0,0 +1,299 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tarfile
+import tempfile
+
+import db
+import repository
+import stats
+import storage
+
+# Exported as <table>.jsonl: a header line with the column names, then one JSON
+# array per row. Derived tables (the catalog, its search index and the stats
+# rollups) are rebuilt after an import instead.
+TABLES = ('users', 'premium_users', 'cards', 'card_stats', 'card_views', 'user_card_selections', 'blobs')
+# Moving to another database also takes what a backup leaves out.
+MIGRATED_TABLES = TABLES + ('card_views_archive', 'conversation_data', 'pending_uploads')
+PRIMARY_KEYS = {
+    'users': ('user_id',),
+    'premium_users': ('user_id',),
+    'cards': ('id',),
+    'card_stats': ('card_id',),
+    'card_views': ('user_id', 'month_year'),
+    'user_card_selections': ('user_id', 'card_id'),
+    'blobs': ('sha256',),
+    'card_views_archive': ('month_year',),
+    'conversation_data': ('kind', 'id'),
+    'pending_uploads': ('user_id',),
+}
+CHUNK_SIZE = 500
+BACKUP_PAGES = 1024
+
+
+def _snapshot():
+    # The online backup API copies the live database page by page through its
+    # own connection, so the bot keeps serving while a consistent copy is made.
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    source = db.connect(db.DATABASE_PATH)
+    target = sqlite3.connect(path)
+    try:
+        source.backup(target, pages=BACKUP_PAGES)
+    finally:
+        target.close()
+        source.close()
+    return path
+
+
+def _dump_table(cursor, table):
+    fd, path = tempfile.mkstemp(suffix=".jsonl")
+    cursor = cursor.execute(f'SELECT * FROM {table}')
+    count = 0
+    with os.fdopen(fd, 'w', encoding='utf-8') as out:
+        out.write(json.dumps([column[0] for column in cursor.description]) + '\n')
+        while rows := cursor.fetchmany(CHUNK_SIZE):
+            # PostgreSQL hands back datetimes; written as text they read back
+            # the same way SQLite stores them.
+            out.writelines(json.dumps(row, ensure_ascii=False, default=str) + '\n' for row in rows)
+            count += len(rows)
+    return path, count
+
+
+def _dump_database(cursor):
+    # Every table, then the photo keys one per line, all read from the same
+    # point in time: a snapshot copy on SQLite, one repeatable-read
+    # transaction on PostgreSQL.
+    if db.DIALECT == 'postgres':
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+    dumps = {table: _dump_table(cursor, table) for table in TABLES}
+    fd, keys_path = tempfile.mkstemp(suffix=".keys")
+    cursor.execute('SELECT DISTINCT photo FROM cards WHERE photo IS NOT NULL ORDER BY photo')
+    with os.fdopen(fd, 'w', encoding='utf-8') as out:
+        while keys := cursor.fetchmany(CHUNK_SIZE):
+            out.writelines(key + '\n' for (key,) in keys)
+    return dumps, keys_path
+
+
+async def _dump_snapshot():
+    if db.DIALECT == 'postgres':
+        return await db.run(_dump_database)
+    snapshot_path = await asyncio.to_thread(_snapshot)
+    snapshot = sqlite3.connect(snapshot_path, check_same_thread=False)
+    try:
+        return await asyncio.to_thread(_dump_database, snapshot.cursor())
+    finally:
+        snapshot.close()
+        os.remove(snapshot_path)
+
+
+def _add_file(archive, name, path):
+    info = tarfile.TarInfo(name)
+    info.size = os.path.getsize(path)
+    with open(path, 'rb') as source:
+        archive.addfile(info, source)
+
+
+async def _spool(chunks):
+    # Tar members need their size up front, so a photo is spooled to a temp
+    # file first; only one chunk at a time is ever held in memory.
+    digest = hashlib.sha256()
+    fd, path = tempfile.mkstemp(suffix=".part")
+    with os.fdopen(fd, 'wb') as out:
+        async for chunk in chunks:
+            digest.update(chunk)
+            out.write(chunk)
+    return path, digest.hexdigest()
+
+
+async def export_archive(fileobj):
+    backend = storage.get_backend()
+    exported = dict.fromkeys(TABLES, 0)
+    photos = 0
+    missing = 0
+
+    dumps, keys_path = await _dump_snapshot()
+    try:
+        with tarfile.open(fileobj=fileobj, mode='w|gz') as archive:
+            for table in TABLES:
+                path, exported[table] = dumps[table]
+                await asyncio.to_thread(_add_file, archive, f"{table}.jsonl", path)
+
+            with open(keys_path, encoding='utf-8') as keys:
+                for key in keys:
+                    key = key.rstrip('\n')
+                    if not await backend.exists(key):
+                        missing += 1
+                        continue
+                    path, _ = await _spool(backend.stream(key))
+                    try:
+                        await asyncio.to_thread(_add_file, archive, key, path)
+                    finally:
+                        os.remove(path)
+                    photos += 1
+    finally:
+        for path, _ in dumps.values():
+            os.remove(path)
+        os.remove(keys_path)
+
+    return exported, photos, missing
+
+
+def _table_columns(cursor, table):
+    if db.DIALECT == 'postgres':
+        cursor.execute('SELECT column_name FROM information_schema.columns WHERE table_name = ?', (table,))
+        return {row[0] for row in cursor.fetchall()}
+    cursor.execute(f'PRAGMA table_info({table})')
+    return {row[1] for row in cursor.fetchall()}
+
+
+def _insert_rows(cursor, table, columns, rows):
+    unknown = set(columns) - _table_columns(cursor, table)
+    if unknown:
+        raise ValueError(f"Неизвестные столбцы {table}: {', '.join(sorted(unknown))}")
+    if table == 'card_stats':
+        # Archives from before the foreign key may hold stats of deleted
+        # cards; they would fail the constraint and are skipped.
+        card_id = columns.index('card_id')
+        rows = [
+            row for row in rows
+            if cursor.execute('SELECT 1 FROM cards WHERE id = ?', (row[card_id],)).fetchone()
+        ]
+    keys = PRIMARY_KEYS[table]
+    updates = ', '.join(f'{column} = excluded.{column}' for column in columns if column not in keys)
+    cursor.executemany(f'''
+        INSERT INTO {table} ({', '.join(columns)})
+        VALUES ({', '.join('?' * len(columns))})
+        ON CONFLICT({', '.join(keys)}) DO {f'UPDATE SET {updates}' if updates else 'NOTHING'}
+    ''', rows)
+    if table == 'premium_users' and 'expiry_notified' not in columns:
+        # Rows from before expiry_notified, as the baseline migration treats them.
+        user_id = columns.index('user_id')
+        cursor.executemany('''
+            UPDATE premium_users SET expiry_notified = 1 WHERE user_id = ? AND premium_until < CURRENT_TIMESTAMP
+        ''', [(row[user_id],) for row in rows])
+
+
+def _finish_import(cursor):
+    if db.DIALECT == 'postgres':
+        # Imported cards keep their ids; new ones continue after them.
+        cursor.execute('''
+            SELECT setval(pg_get_serial_sequence('cards', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM cards
+        ''')
+    # Archives from before cards.name_key leave it empty.
+    db.fill_name_keys(cursor)
+    db.rebuild_catalog(cursor)
+    cursor.execute('''
+        UPDATE blobs SET refcount = (SELECT COUNT(*) FROM cards WHERE cards.photo = blobs.path)
+    ''')
+    stats.rebuild(cursor)
+
+
+async def _import_table(member_file, table):
+    # Members of a streamed archive are not seekable, so lines are read as
+    # bytes; json.loads takes UTF-8 bytes as they are.
+    columns = json.loads(member_file.readline())
+    imported = 0
+    chunk = []
+    for line in member_file:
+        chunk.append(json.loads(line))
+        if len(chunk) == CHUNK_SIZE:
+            await db.run(_insert_rows, table, columns, chunk)
+            imported += len(chunk)
+            chunk = []
+    if chunk:
+        await db.run(_insert_rows, table, columns, chunk)
+        imported += len(chunk)
+    return imported
+
+
+async def _read_member(member_file):
+    while chunk := await asyncio.to_thread(member_file.read, storage.CHUNK_SIZE):
+        yield chunk
+
+
+async def import_archive(fileobj):
+    # Rows keep their ids and replace rows with the same key, so an archive is
+    # meant to be restored into an empty database or over the one it came from.
+    backend = storage.get_backend()
+    imported = dict.fromkeys(TABLES, 0)
+    photos = 0
+
+    with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+        for member in archive:
+            name = member.name
+            table = name.removesuffix('.jsonl')
+            if not member.isfile():
+                continue
+            if table in TABLES and name.endswith('.jsonl'):
+                imported[table] += await _import_table(archive.extractfile(member), table)
+            elif name.startswith(f"{storage.PHOTOS_DIR}/") and '..' not in name.split('/'):
+                if await backend.exists(name):
+                    continue
+                path, sha256 = await _spool(_read_member(archive.extractfile(member)))
+                try:
+                    await backend.put_file(name, path, sha256)
+                finally:
+                    if os.path.exists(path):
+                        os.remove(path)
+                photos += 1
+
+    await db.run(_finish_import)
+    repository.reset_caches()
+    return imported, photos
+
+
+async def migrate_database(path):
+    # Copies an SQLite database file into the configured database, normally
+    # PostgreSQL through DATABASE_URL. Photos stay where they are; only the
+    # rows move. The file should have been opened by this version of the bot
+    # once, so its schema is current.
+    source = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    migrated = dict.fromkeys(MIGRATED_TABLES, 0)
+    try:
+        for table in MIGRATED_TABLES:
+            dump_path, _ = await asyncio.to_thread(_dump_table, source.cursor(), table)
+            try:
+                with open(dump_path, 'rb') as dump:
+                    migrated[table] = await _import_table(dump, table)
+            finally:
+                os.remove(dump_path)
+    finally:
+        source.close()
+
+    await db.run(_finish_import)
+    repository.reset_caches()
+    return migrated
+
+
+def _format_counts(counts):
+    return ", ".join(f"{table}: {count}" for table, count in counts.items())
+
+
+async def _main(command, path):
+    db.create_database()
+    try:
+        if command == "migrate":
+            migrated = await migrate_database(path)
+            print(f"Перенесено: {_format_counts(migrated)}.", file=sys.stderr)
+        elif command == "export":
+            with (open(path, 'wb') if path != "-" else sys.stdout.buffer) as out:
+                exported, photos, missing = await export_archive(out)
+            print(f"Выгружено: {_format_counts(exported)}. Фото: {photos}, не найдено: {missing}.", file=sys.stderr)
+        else:
+            with (open(path, 'rb') if path != "-" else sys.stdin.buffer) as source:
+                imported, photos = await import_archive(source)
+            print(f"Загружено: {_format_counts(imported)}. Фото: {photos}.", file=sys.stderr)
+    finally:
+        await storage.close()
+        db.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in ("export", "import", "migrate"):
+        sys.exit("Использование: python backup.py export|import <архив.tar.gz|->\n"
+                 "               python backup.py migrate <discount_cards.db>")
+    asyncio.run(_main(sys.argv[1], sys.argv[2]))
@@ -0,0 +1,49 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+
+import db
+import repository
+
+
+def legacy_monthly_views(cursor, user_id):
+    month = repository.get_current_month_year()
+    cursor.execute('SELECT views_count FROM card_views WHERE user_id = ? AND month_year = ?', (user_id, month))
+    result = cursor.fetchone()
+    if result is None:
+        cursor.execute('INSERT INTO card_views (user_id, month_year, views_count) VALUES (?, ?, 0)', (user_id, month))
+        return 0
+    return result[0]
+
+
+async def legacy_list_access(user_id):
+    # can_view_more_cards(), then get_user_monthly_views() and has_premium_access() for views_info
+    if not await repository.has_premium_access(user_id):
+        await db.run(legacy_monthly_views, user_id)
+    await db.run(legacy_monthly_views, user_id)
+    await repository.has_premium_access(user_id)
+
+
+async def list_access(user_id):
+    await repository.get_access_context(user_id)
+
+
+async def count(name, access, user_id):
+    before = db.statement_count()
+    await access(user_id)
+    print(f"{name:>8}: {db.statement_count() - before} statements per /list update")
+
+
+async def main():
+    db.create_database()
+    await count("legacy", legacy_list_access, 1)
+    await count("context", list_access, 2)
+    db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
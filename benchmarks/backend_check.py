@@ -0,0 +1,146 @@
+import asyncio
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if "DATABASE_URL" not in os.environ:
+    os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "check.db")
+
+import db
+import repository
+import stats
+
+# Runs the repository against whichever database is configured and checks
+# that both backends behave the same. Point DATABASE_URL at an empty
+# PostgreSQL database to check that one; without it a temporary SQLite file
+# is used.
+NAMES = ("Магнит", "Магнит у дома", "Пятёрочка", "Decathlon", "Ёлки-палки", "Лента")
+
+failures = []
+
+
+def expect(label, actual, expected):
+    status = "ok" if actual == expected else "FAIL"
+    print(f"{status:>4}  {label}: {actual!r}" + ("" if actual == expected else f", expected {expected!r}"))
+    if actual != expected:
+        failures.append(label)
+
+
+async def check_cards():
+    created = [await repository.save_card(user_id, name, f"photos/{user_id}.jpg")
+               for user_id, name in enumerate(NAMES, start=1)]
+    expect("new cards created", created, [True] * len(NAMES))
+    expect("same name updates the card", await repository.save_card(99, "  магнит ", "photos/99.jpg"), False)
+
+    _, page = await repository.get_ranked_page(0, 4)
+    expect("first page", [name for _, name in page], list(NAMES[:4]))
+
+    for query, expected in (("ма", "Магнит"), ("магнт", "Магнит"), ("пятерочка", "Пятёрочка"),
+                            ("елки", "Ёлки-палки"), ("ёл", "Ёлки-палки"), ("ел", "Ёлки-палки"),
+                            ("decatlon", "Decathlon")):
+        results = await repository.search_cards(query)
+        expect(f"search {query!r}", results[0][1] if results else None, expected)
+
+    card_id = page[0][0]
+    for _ in range(3):
+        await repository.select_card(card_id)
+    await repository.write_buffer.flush()
+    expect("selections counted", await db.fetchone('SELECT selection_count FROM card_stats WHERE card_id = ?',
+                                                   (card_id,)), (3,))
+    expect("card deleted", await repository.delete_card("МАГНИТ"), True)
+    expect("stats deleted with the card", await db.fetchone('SELECT COUNT(*) FROM card_stats'), (0,))
+    expect("catalog after delete", len((await repository.get_ranked_page(0, 10))[1]), len(NAMES) - 1)
+
+
+async def check_ranking():
+    version, cards = await repository.get_ranked_page(0, 10)
+    expect("unselected cards by id", [card_id for card_id, _ in cards], sorted(card_id for card_id, _ in cards))
+    card_id = cards[-1][0]
+    for _ in range(2):
+        await repository.select_card(card_id, user_id=7)
+    expect("selected card first", (await repository.get_ranked_page(0, 1))[1][0][0], card_id)
+    expect("page turned on its snapshot", (await repository.get_ranked_page(1, 2, version))[1], cards[2:4])
+    await repository.write_buffer.flush()
+    await repository.load_ranking()
+    expect("ranking after reload", (await repository.get_ranked_page(0, 1))[1][0][0], card_id)
+    expect("favorites", await repository.get_favorite_cards(7, 3), [cards[-1]])
+
+
+async def check_premium():
+    until = datetime.utcnow() + timedelta(days=30)
+    await repository.add_premium(1, until)
+    await repository.add_premium(1, until + timedelta(days=30))
+    repository.reset_caches()
+    expect("premium active", (await repository.get_access_context(1)).is_premium, True)
+    await repository.revoke_premium(1)
+    expect("premium revoked", (await repository.get_access_context(1)).is_premium, False)
+
+    await repository.add_premium(2, datetime.utcnow() - timedelta(days=1))
+    await repository.add_premium(3, datetime.utcnow() - timedelta(days=2))
+    expect("expired premium claimed", sorted(await repository.claim_expired_premium(10)), [2, 3])
+    expect("claimed only once", await repository.claim_expired_premium(10), [])
+
+
+async def check_views_and_users():
+    for user_id in (1, 2, 2, 3):
+        await repository.update_user_stats(user_id)
+        await repository.increment_user_views(user_id)
+    await repository.write_buffer.flush()
+    repository.reset_caches()
+    expect("monthly views", (await repository.get_access_context(2)).monthly_views, 2)
+
+    await db.execute('INSERT INTO card_views (user_id, month_year, views_count) VALUES (?, ?, ?)', (1, "2000-01", 4))
+    await repository.archive_card_views("2001-01")
+    expect("views archived", await db.fetchone('SELECT users, views FROM card_views_archive'), (1, 4))
+
+
+async def check_uploads():
+    await repository.set_pending_upload(1, "photos/old.jpg", "file-1", None)
+    await repository.set_pending_upload(1, "photos/new.jpg", "file-2", ("4601234567893", "EAN13"))
+    expect("newer upload taken", await repository.take_pending_upload(1),
+           ("photos/new.jpg", "file-2", ("4601234567893", "EAN13")))
+    expect("upload taken only once", await repository.take_pending_upload(1), None)
+
+    await repository.set_pending_upload(2, "photos/held.jpg", None, None)
+    await repository.set_pending_upload(3, "photos/stale.jpg", None, None)
+    await db.execute('UPDATE pending_uploads SET uploaded_at = 0 WHERE user_id = 3')
+    expect("expired upload not taken", await repository.take_pending_upload(3), None)
+    await repository.set_pending_upload(3, "photos/stale.jpg", None, None)
+    await db.execute('UPDATE pending_uploads SET uploaded_at = 0 WHERE user_id = 3')
+    expect("expired uploads removed", await repository.delete_expired_uploads(), 1)
+
+
+async def check_blobs():
+    await repository.register_blob("a" * 64, "photos/orphan.jpg", 100)
+    await repository.register_blob("b" * 64, "photos/fresh.jpg", 100)
+    await repository.register_blob("c" * 64, "photos/held.jpg", 100)
+    await db.execute('UPDATE blobs SET created_at = ? WHERE path IN (?, ?)',
+                     ("2000-01-01 00:00:00", "photos/orphan.jpg", "photos/held.jpg"))
+    expect("orphan blobs removed", await repository.delete_orphan_blobs(), ["photos/orphan.jpg"])
+
+
+async def main():
+    expect("migrations applied", db.create_database(), [version for version, _, _ in db.MIGRATIONS])
+    expect("migrations applied again", db.create_database(), [])
+    print(f"backend: {db.DIALECT}")
+    try:
+        await check_cards()
+        await check_ranking()
+        await check_premium()
+        await check_views_and_users()
+        await check_uploads()
+        await check_blobs()
+        expect("statistics rollups", db.run_sync(stats.check), [])
+        snapshot = await repository.collect_stats()
+        expect("stats snapshot users", snapshot['total_users'], 3)
+    finally:
+        db.close()
+
+    print(f"{len(failures)} failed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,52 @@
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+
+import db
+import repository
+
+NAMES = 100_000
+REPEAT = 20
+SYLLABLES = ("ма", "гни", "ле", "нта", "пя", "тёр", "оч", "ка", "ко", "сме", "тик", "ру", "ба", "shop", "mar", "ket",
+             "deca", "th", "lon", "ike", "a", "fam", "ily", "sport", "plus", "club")
+QUERIES = ("ма", "магнит", "магнт", "пятерочка", "sport", "spotr club", "deca", "zzzz")
+
+
+def seed(cursor):
+    random.seed(1)
+    names = set()
+    while len(names) < NAMES:
+        words = (''.join(random.choice(SYLLABLES) for _ in range(random.randint(2, 4))) for _ in range(random.randint(1, 2)))
+        names.add(' '.join(words).capitalize())
+    cursor.executemany('INSERT INTO cards (id, user_id, name, photo) VALUES (?, 1, ?, ?)',
+                       ((i, name, f"photos/{i}.jpg") for i, name in enumerate(names, start=1)))
+    cursor.executemany('INSERT INTO card_catalog (name_key, card_id, name) VALUES (?, ?, ?)',
+                       ((db.normalize_name(name), i, name) for i, name in enumerate(names, start=1)))
+
+
+def main():
+    db.create_database()
+    started = time.perf_counter()
+    db.run_sync(seed)
+    print(f"indexed {NAMES} names in {time.perf_counter() - started:.1f} s")
+
+    for query in QUERIES:
+        normalized = db.normalize_search(query)
+        timings = []
+        for _ in range(REPEAT):
+            started = time.perf_counter()
+            results = db.run_sync(repository._search_cards, normalized, 10)
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        print(f"{query!r:>14}: p50 {timings[len(timings) // 2] * 1000:7.2f} ms  "
+              f"max {timings[-1] * 1000:7.2f} ms  top: {', '.join(card[1] for card in results[:3])}")
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import asyncio
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+
+import db
+import repository
+
+USERS = 200
+ITERATIONS = 2000
+CONCURRENCY = 8
+
+
+def legacy_handler(user_id):
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    cursor = conn.cursor()
+    cursor.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
+    cursor.execute('UPDATE users SET last_use = CURRENT_TIMESTAMP WHERE user_id = ?', (user_id,))
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(db.DATABASE_PATH)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT premium_until FROM premium_users WHERE user_id = ? AND premium_until >= CURRENT_TIMESTAMP
+    ''', (user_id,))
+    cursor.fetchone()
+    conn.close()
+
+
+async def pooled_handler(user_id):
+    await repository.update_user_stats(user_id)
+    await repository.has_premium_access(user_id)
+
+
+async def watch_loop_lag(samples, stop):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        samples.append(time.perf_counter() - started - 0.001)
+
+
+async def measure(name, handler):
+    latencies = []
+    lag = []
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(watch_loop_lag(lag, stop))
+
+    async def worker(offset):
+        for i in range(offset, ITERATIONS, CONCURRENCY):
+            started = time.perf_counter()
+            result = handler(i % USERS)
+            if asyncio.iscoroutine(result):
+                await result
+            latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(0)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(offset) for offset in range(CONCURRENCY)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await watcher
+
+    latencies.sort()
+    print(
+        f"{name:>8}: {ITERATIONS / elapsed:8.0f} handlers/s  "
+        f"p50 {latencies[len(latencies) // 2] * 1000:7.3f} ms  "
+        f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:7.3f} ms  "
+        f"max loop lag {max(lag, default=0) * 1000:7.3f} ms  "
+        f"mean loop lag {statistics.mean(lag or [0]) * 1000:7.3f} ms"
+    )
+
+
+async def main():
+    db.create_database()
+    await measure("legacy", legacy_handler)
+    await measure("pooled", pooled_handler)
+    db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
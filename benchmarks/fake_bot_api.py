@@ -0,0 +1,330 @@
+import asyncio
+import hashlib
+import inspect
+import json
+import time
+from collections import Counter, deque
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qs
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Cards", "username": "cards_bot"}
+PHOTO_SIDES = (90, 320, 800, 1280)
+STATUS_LINES = {200: b"200 OK", 400: b"400 Bad Request", 404: b"404 Not Found", 429: b"429 Too Many Requests"}
+
+
+def _decode(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+class FakeBotApi:
+    # A local stand-in for api.telegram.org. Point the bot at it with
+    # TELEGRAM_API_URL=<url>; every call is counted and answered after
+    # `latency` seconds. With `flood_limits=(overall, per_chat)` it behaves
+    # like Telegram's flood control: more messages per second than that,
+    # bot-wide or into one chat, are answered with 429 and retry_after.
+    #
+    # Updates queued with push_update() are served by getUpdates, long polling
+    # included. Files registered with add_file(), and photos the bot uploads,
+    # get file ids that getFile, downloads and sendPhoto by reference accept.
+    def __init__(self, latency=0.0, flood_limits=None, retry_after=1):
+        self.latency = latency
+        self.flood_limits = flood_limits
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.flooded = Counter()
+        self.files = {}
+        self.listeners = []
+        self.port = None
+        self._sent = deque()
+        self._server = None
+        self._connections = {}
+        self._message_id = 0
+        self._updates = []
+        self._update_id = 0
+        self._new_updates = asyncio.Condition()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        # Wakes up pending long polls and lets every connection finish.
+        self._server.close()
+        async with self._new_updates:
+            self._new_updates.notify_all()
+        for writer in self._connections.values():
+            writer.close()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def push_update(self, update):
+        # Numbers the update and wakes up a pending getUpdates.
+        self._update_id += 1
+        update["update_id"] = self._update_id
+        async with self._new_updates:
+            self._updates.append(update)
+            self._new_updates.notify_all()
+        return self._update_id
+
+    def add_file(self, content):
+        file_unique_id = hashlib.sha256(content).hexdigest()[:16]
+        file_id = f"file-{file_unique_id}"
+        self.files[file_id] = content
+        return file_id
+
+    def photo_sizes(self, file_id):
+        # What Telegram puts in message.photo: every resolution, smallest first.
+        # They all point to the same bytes here.
+        size = len(self.files[file_id])
+        return [
+            {"file_id": file_id if side == PHOTO_SIDES[-1] else f"{file_id}-{side}",
+             "file_unique_id": f"{file_id}-{side}", "width": side, "height": side * 3 // 4, "file_size": size}
+            for side in PHOTO_SIDES
+        ]
+
+    async def _handle(self, reader, writer):
+        self._connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                http_method, path, _ = request_line.decode().split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, value = line.decode().split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                if http_method == "GET" and path.startswith("/file/"):
+                    status, content_type, payload = self._download(path)
+                else:
+                    response = await self._dispatch(path, headers, body)
+                    status = response.get("error_code", 200)
+                    content_type, payload = "application/json", json.dumps(response).encode()
+                writer.write(
+                    b"HTTP/1.1 " + STATUS_LINES[status] + b"\r\n"
+                    + f"Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.pop(asyncio.current_task(), None)
+            writer.close()
+
+    def _download(self, path):
+        # /file/bot<token>/photos/<file_id>.jpg
+        file_id = path.rsplit("/", 1)[-1].removesuffix(".jpg")
+        self.calls["download"] += 1
+        if file_id not in self.files:
+            return 404, "text/plain", b"Not Found"
+        return 200, "image/jpeg", self.files[file_id]
+
+    def _parse(self, headers, body):
+        if not body:
+            return {}
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("application/json"):
+            return json.loads(body)
+        if content_type.startswith("multipart/form-data"):
+            # Uploads come as multipart: file parts stay bytes, the other
+            # fields are decoded like urlencoded ones.
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            params = {}
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                payload = part.get_payload(decode=True)
+                params[name] = payload if part.get_filename() else _decode(payload.decode())
+            return params
+        return {name: _decode(values[0]) for name, values in parse_qs(body.decode()).items()}
+
+    async def _dispatch(self, path, headers, body):
+        api_method = path.rsplit("/", 1)[-1]
+        params = self._parse(headers, body)
+        if self.latency and api_method != "getUpdates":
+            await asyncio.sleep(self.latency)
+
+        if self._flooded(params):
+            self.flooded[api_method] += 1
+            return {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+
+        self.calls[api_method] += 1
+        handler = getattr(self, f"api_{api_method}", None)
+        try:
+            result = handler(params) if handler else True
+            if inspect.isawaitable(result):
+                result = await result
+        except LookupError as exc:
+            return {"ok": False, "error_code": 400, "description": f"Bad Request: {exc.args[0]}"}
+        for listener in self.listeners:
+            listener(api_method, params)
+        return {"ok": True, "result": result}
+
+    def _flooded(self, params):
+        if not self.flood_limits or "chat_id" not in params:
+            return False
+        overall, per_chat = self.flood_limits
+        now = time.monotonic()
+        while self._sent and self._sent[0][0] <= now - 1:
+            self._sent.popleft()
+        chat_id = int(params["chat_id"])
+        if len(self._sent) >= overall or sum(1 for _, sent_to in self._sent if sent_to == chat_id) >= per_chat:
+            return True
+        self._sent.append((now, chat_id))
+        return False
+
+    def _message(self, params, **fields):
+        self._message_id += 1
+        chat_id = int(params["chat_id"])
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "from": BOT_USER,
+            **fields,
+        }
+
+    def _file_id(self, value):
+        # A file id string refers to a known file; anything else is an upload.
+        if isinstance(value, bytes):
+            return self.add_file(value)
+        file_id = str(value).rsplit("-", 1)[0] if str(value) not in self.files else str(value)
+        if file_id not in self.files:
+            raise LookupError("wrong file identifier/HTTP URL specified")
+        return file_id
+
+    async def api_getUpdates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        async with self._new_updates:
+            # Confirmed updates are forgotten, as Telegram does.
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            if not self._updates and timeout:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self._updates[:limit]
+
+    def api_getMe(self, params):
+        return BOT_USER
+
+    def api_sendMessage(self, params):
+        return self._message(params, text=str(params.get("text", "")))
+
+    def api_sendPhoto(self, params):
+        file_id = self._file_id(params["photo"])
+        caption = {"caption": str(params["caption"])} if "caption" in params else {}
+        return self._message(params, photo=self.photo_sizes(file_id), **caption)
+
+    def api_editMessageText(self, params):
+        return self._message(params, message_id=int(params.get("message_id", 0)), text=str(params["text"]),
+                             edit_date=int(time.time()))
+
+    def api_getFile(self, params):
+        file_id = self._file_id(params["file_id"])
+        return {"file_id": params["file_id"], "file_unique_id": file_id, "file_size": len(self.files[file_id]),
+                "file_path": f"photos/{file_id}.jpg"}
+
+    def api_sendInvoice(self, params):
+        return self._message(params, invoice={
+            "title": params["title"],
+            "description": params["description"],
+            "start_parameter": params.get("start_parameter", ""),
+            "currency": params["currency"],
+            "total_amount": sum(price["amount"] for price in params["prices"]),
+        })
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+
+
+def _user_message(update_id, user_id, **fields):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": _user(user_id),
+            **fields,
+        },
+    }
+
+
+def command_update(update_id, user_id, text):
+    command = text.split()[0]
+    return _user_message(update_id, user_id, text=text,
+                         entities=[{"type": "bot_command", "offset": 0, "length": len(command)}])
+
+
+def text_update(update_id, user_id, text):
+    return _user_message(update_id, user_id, text=text)
+
+
+def photo_update(update_id, user_id, photo_sizes):
+    return _user_message(update_id, user_id, photo=photo_sizes)
+
+
+def callback_update(update_id, user_id, data, message_id=1):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": f"{user_id}-{update_id}",
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": BOT_USER,
+                "text": "📋",
+            },
+        },
+    }
+
+
+def pre_checkout_update(update_id, user_id, payload, total_amount, currency="XTR"):
+    return {
+        "update_id": update_id,
+        "pre_checkout_query": {
+            "id": f"{user_id}-{update_id}",
+            "from": _user(user_id),
+            "currency": currency,
+            "total_amount": total_amount,
+            "invoice_payload": payload,
+        },
+    }
+
+
+def payment_update(update_id, user_id, payload, total_amount, currency="XTR"):
+    return _user_message(update_id, user_id, successful_payment={
+        "currency": currency,
+        "total_amount": total_amount,
+        "invoice_payload": payload,
+        "telegram_payment_charge_id": f"charge-{update_id}",
+        "provider_payment_charge_id": f"provider-{update_id}",
+    })
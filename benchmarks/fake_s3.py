@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import hmac
+import re
+
+STATUS_LINES = {200: b"200 OK", 204: b"204 No Content", 400: b"400 Bad Request", 403: b"403 Forbidden",
+                404: b"404 Not Found", 411: b"411 Length Required"}
+_AUTHORIZATION = re.compile(
+    r"AWS4-HMAC-SHA256 Credential=(?P<access_key>[^/]+)/(?P<scope>[^,]+), "
+    r"SignedHeaders=(?P<signed_headers>[^,]+), Signature=(?P<signature>[0-9a-f]+)$")
+
+
+class FakeS3:
+    # A local stand-in for an S3-compatible server: path-style PUT, GET, HEAD
+    # and DELETE on one bucket, objects kept in `objects` by key. Every request
+    # must carry a valid AWS Signature V4 for `access_key`/`secret_key`, and a
+    # PUT must come with a Content-Length and a body matching its
+    # x-amz-content-sha256, as S3 itself insists. Requests are counted by
+    # method in `calls`.
+    def __init__(self, bucket="cards", access_key="minioadmin", secret_key="minioadmin", region="us-east-1"):
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.objects = {}
+        self.calls = {}
+        self.port = None
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, value = line.decode().split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                self.calls[method] = self.calls.get(method, 0) + 1
+                status, payload = self._dispatch(method, path, headers, body)
+                writer.write(
+                    b"HTTP/1.1 " + STATUS_LINES[status] + b"\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode()
+                    + (b"" if method == "HEAD" else payload)
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _dispatch(self, method, path, headers, body):
+        error = self._check_signature(method, path, headers)
+        if error:
+            return 403, error.encode()
+        prefix = f"/{self.bucket}/"
+        if not path.startswith(prefix):
+            return 404, b"NoSuchBucket"
+        key = path[len(prefix):]
+
+        if method == "PUT":
+            if "content-length" not in headers:
+                return 411, b"MissingContentLength"
+            if hashlib.sha256(body).hexdigest() != headers["x-amz-content-sha256"]:
+                return 400, b"XAmzContentSHA256Mismatch"
+            self.objects[key] = body
+            return 200, b""
+        if method == "DELETE":
+            self.objects.pop(key, None)
+            return 204, b""
+        if key not in self.objects:
+            return 404, b"NoSuchKey"
+        return 200, self.objects[key]
+
+    def _check_signature(self, method, path, headers):
+        # The server side of S3Storage._request: the canonical request is
+        # rebuilt from what actually arrived and signed with the shared secret.
+        match = _AUTHORIZATION.match(headers.get("authorization", ""))
+        if not match:
+            return "AccessDenied"
+        if match["access_key"] != self.access_key:
+            return "InvalidAccessKeyId"
+        date, region, service, terminator = match["scope"].split("/")
+        amz_date = headers.get("x-amz-date", "")
+        if not amz_date.startswith(date) or (region, service, terminator) != (self.region, "s3", "aws4_request"):
+            return "AuthorizationHeaderMalformed"
+
+        signed_headers = match["signed_headers"].split(";")
+        if "host" not in signed_headers or any(name not in headers for name in signed_headers):
+            return "AccessDenied"
+        canonical_request = "\n".join([
+            method,
+            path,
+            "",
+            "".join(f"{name}:{headers[name]}\n" for name in signed_headers),
+            match["signed_headers"],
+            headers.get("x-amz-content-sha256", ""),
+        ])
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            match["scope"],
+            hashlib.sha256(canonical_request.encode()).hexdigest(),
+        ])
+        signing_key = f"AWS4{self.secret_key}".encode()
+        for part in (date, region, service, terminator):
+            signing_key = hmac.new(signing_key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(signature, match["signature"]):
+            return "SignatureDoesNotMatch"
+        return None
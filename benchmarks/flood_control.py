@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+
+from telegram import Update
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+from telegram.request import HTTPXRequest
+
+from fake_bot_api import FakeBotApi, command_update
+
+import ratelimit
+
+TOKEN = "123456:TEST"
+
+
+async def broadcast(api, limiter, args):
+    # Every chat gets `--per-chat` messages and one group gets `--group`, all
+    # sent at once, the way a notification job would.
+    bot = ExtBot(TOKEN, base_url=f"{api.url}/bot", rate_limiter=limiter,
+                 request=HTTPXRequest(connection_pool_size=256))
+    await bot.initialize()
+    api.flooded.clear()
+    api.calls.clear()
+    failed = 0
+
+    async def send(chat_id, text):
+        nonlocal failed
+        try:
+            await bot.send_message(chat_id, text)
+        except RetryAfter:
+            failed += 1
+
+    sends = [send(chat_id, f"{n}") for chat_id in range(1000, 1000 + args.chats) for n in range(args.per_chat)]
+    sends += [send(-1000, f"{n}") for n in range(args.group)]
+    started = time.perf_counter()
+    await asyncio.gather(*sends)
+    elapsed = time.perf_counter() - started
+    await bot.shutdown()
+
+    name = "limited" if limiter else "unlimited"
+    print(f"{name:>9}: {len(sends)} messages in {elapsed:5.2f} s  delivered {api.calls['sendMessage']:4}  "
+          f"429s {api.flooded['sendMessage']:4}  gave up {failed:4}")
+
+
+async def spam(api, args):
+    # One user hammers /list; only what the inbound limiter lets through
+    # reaches the handler and sends a reply.
+    os.environ["TELEGRAM_API_URL"] = api.url
+    import db
+    import main
+
+    db.create_database()
+    application = main.build_application(TOKEN)
+    await application.initialize()
+    await application.start()
+    api.calls.clear()
+    started = time.perf_counter()
+    for update_id in range(args.spam):
+        update = Update.de_json(command_update(update_id, 42, "/list"), application.bot)
+        await application.process_update(update)
+        await asyncio.sleep(args.spam_seconds / args.spam)
+    await asyncio.sleep(args.spam_seconds / 2)
+    elapsed = time.perf_counter() - started
+    await application.stop()
+    await application.shutdown()
+
+    dropped = ratelimit.inbound_dropped.value('user') + ratelimit.inbound_dropped.value('chat')
+    print(f"inbound: {args.spam} updates from one user in {elapsed:.1f} s, "
+          f"{args.spam - dropped} handled, {api.calls['sendMessage']} messages sent, "
+          f"dropped {ratelimit.inbound_dropped.value('user')} by user, "
+          f"{ratelimit.inbound_dropped.value('chat')} by chat limit")
+
+
+async def run(args):
+    api = FakeBotApi(flood_limits=(args.overall_limit, args.chat_limit), retry_after=1)
+    await api.start()
+    await broadcast(api, None, args)
+    await asyncio.sleep(1)
+    await broadcast(api, ratelimit.OutboundRateLimiter(), args)
+    api.flood_limits = None
+    await spam(api, args)
+    await api.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Broadcast and spam against a Bot API stand-in with flood control.")
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--per-chat", type=int, default=2, help="messages per private chat")
+    parser.add_argument("--group", type=int, default=10, help="messages into one group chat")
+    parser.add_argument("--overall-limit", type=int, default=30, help="messages per second the stand-in accepts")
+    parser.add_argument("--chat-limit", type=int, default=4, help="messages per second per chat it accepts")
+    parser.add_argument("--spam", type=int, default=100, help="updates the spamming user sends")
+    parser.add_argument("--spam-seconds", type=float, default=5.0)
+    asyncio.run(run(parser.parse_args()))
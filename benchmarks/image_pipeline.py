@@ -0,0 +1,72 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw, ImageFilter
+
+import images
+
+
+def make_photo(path, seed, width=2560, height=1920):
+    # A light card with a barcode on a darker, noisy table, like a phone photo.
+    rng = random.Random(seed)
+    image = Image.effect_noise((width, height), 40).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    left, top = rng.randint(100, 500), rng.randint(100, 400)
+    draw.rounded_rectangle((left, top, left + 1600, top + 1000), 60, fill=(235, 230, 220))
+    x = left + 200
+    while x < left + 1400:
+        bar = rng.randint(4, 16)
+        draw.rectangle((x, top + 500, x + bar, top + 850), fill=(20, 20, 20))
+        x += bar + rng.randint(4, 16)
+    image.filter(ImageFilter.GaussianBlur(1)).save(path, "JPEG", quality=95)
+
+
+async def run_pool(workers, sources, directory, enhance):
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    loop = asyncio.get_running_loop()
+    # Warm the workers up so process start-up is not counted.
+    await asyncio.gather(*(loop.run_in_executor(executor, time.sleep, 0.01) for _ in range(workers)))
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(
+        loop.run_in_executor(executor, images.normalize_file, source,
+                             os.path.join(directory, f"out-{workers}-{n}.jpg"), enhance)
+        for n, source in enumerate(sources)
+    ))
+    elapsed = time.perf_counter() - started
+    executor.shutdown()
+    return elapsed, sum(size for _, size, _ in results)
+
+
+async def main(args):
+    directory = tempfile.mkdtemp()
+    sources = []
+    for n in range(args.photos):
+        path = os.path.join(directory, f"source-{n}.jpg")
+        make_photo(path, n)
+        sources.append(path)
+    source_size = sum(os.path.getsize(path) for path in sources)
+
+    print(f"{args.photos} photos, {source_size / args.photos / 1024:.0f} KB each, enhance={args.enhance}, "
+          f"{os.cpu_count()} CPUs")
+    for workers in args.workers:
+        elapsed, size = await run_pool(workers, sources, directory, args.enhance)
+        print(f"workers={workers:2}: {args.photos / elapsed:6.1f} photos/s, "
+              f"output {size / args.photos / 1024:.0f} KB each ({size / source_size * 100:.0f}% of input)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Image normalization throughput by worker count.")
+    parser.add_argument("--photos", type=int, default=32)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--enhance", action="store_true")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,74 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+
+import db
+import metrics
+
+CALLS = 100_000
+DB_CALLS = 20_000
+
+
+async def noop(update, context):
+    return None
+
+
+async def per_call(callback, calls=CALLS):
+    started = time.perf_counter()
+    for _ in range(calls):
+        await callback(None, None)
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+async def db_per_call(run, calls=DB_CALLS):
+    started = time.perf_counter()
+    for _ in range(calls):
+        await run(lambda cursor: cursor.execute('SELECT 1').fetchone())
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+async def uninstrumented_run(func):
+    # db.run without metrics: no timing, and the statement count is dropped.
+    backend = db.get_backend()
+    result, _ = await asyncio.get_running_loop().run_in_executor(backend.executor, backend.call, func, ())
+    return result
+
+
+async def main():
+    db.create_database()
+
+    bare = await per_call(noop)
+    wrapped = await per_call(metrics.instrument(noop))
+    print(f"handler wrapper:  {bare:6.2f} us bare, {wrapped:6.2f} us instrumented (+{wrapped - bare:.2f} us per update)")
+
+    await db_per_call(db.run, 1000)
+    bare = await db_per_call(uninstrumented_run)
+    counted = await db_per_call(db.run)
+    print(f"db.run:           {bare:6.2f} us bare, {counted:6.2f} us instrumented (+{counted - bare:.2f} us per call)")
+
+    for handler in range(20):
+        for _ in range(100):
+            metrics.handler_duration.observe(0.01, f"handler_{handler}")
+            metrics.telegram_duration.observe(0.05, f"method_{handler}")
+    started = time.perf_counter()
+    body = metrics.render()
+    print(f"render:           {(time.perf_counter() - started) * 1000:6.2f} ms for {body.count(chr(10))} lines")
+
+    server = metrics.MetricsServer(port=0)
+    await server.start()
+    async with httpx.AsyncClient() as client:
+        response = await client.get(f"http://127.0.0.1:{server.port}/metrics")
+    print(f"scrape:           HTTP {response.status_code}, {len(response.content)} bytes")
+    await server.stop()
+    db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,100 @@
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+
+import db
+import ranking
+import repository
+
+SIZES = (1_000, 10_000, 100_000)
+SELECTIONS = 20_000
+PAGE_SIZE = 10
+REPEAT = 20
+
+
+def seed(cursor, cards):
+    # Popularity is heavy-tailed: a few stores get most of the selections,
+    # and a third of the catalog was never selected at all.
+    random.seed(1)
+    cursor.execute('DELETE FROM card_catalog')
+    cursor.execute('DELETE FROM cards')
+    cursor.executemany('INSERT INTO cards (id, user_id, name, photo) VALUES (?, 1, ?, ?)',
+                       ((card_id, f"Store {card_id}", f"photos/{card_id}.jpg") for card_id in range(1, cards + 1)))
+    cursor.executemany('INSERT INTO card_catalog (name_key, card_id, name) VALUES (?, ?, ?)',
+                       ((f"store {card_id}", card_id, f"Store {card_id}") for card_id in range(1, cards + 1)))
+    now = time.time()
+    cursor.executemany('INSERT INTO card_stats (card_id, selection_count, popularity) VALUES (?, ?, ?)',
+                       ((card_id, count, count * ranking.weight(now - random.uniform(0, 90 * 86400)))
+                        for card_id in range(1, cards + 1)
+                        if (count := int(random.paretovariate(1.2))) > 1))
+
+
+def sql_page(cursor, page):
+    # The same page straight from the database, for comparison.
+    cursor.execute('''
+        SELECT card_catalog.card_id, card_catalog.name
+        FROM card_catalog LEFT JOIN card_stats ON card_stats.card_id = card_catalog.card_id
+        ORDER BY COALESCE(card_stats.popularity, 0) DESC, card_catalog.card_id
+        LIMIT ? OFFSET ?
+    ''', (PAGE_SIZE, page * PAGE_SIZE))
+    return cursor.fetchall()
+
+
+def p50(func, *args):
+    timings = []
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+def main():
+    db.create_database()
+    print(f"{'cards':>8} {'read ms':>8} {'sort ms':>8} {'select us':>10} {'snapshot us':>12} {'page us':>8} "
+          f"{'sql page ms':>12}")
+    for cards in SIZES:
+        db.run_sync(seed, cards)
+        popularity = ranking.Ranking()
+
+        read = p50(lambda: db.run_sync(repository._load_ranking))
+        rows = db.run_sync(repository._load_ranking)
+        sort = p50(popularity.load, rows)
+
+        # Incremental refresh: one selection moves one card.
+        card_ids = [random.randint(1, cards) for _ in range(SELECTIONS)]
+        delta = ranking.weight()
+        started = time.perf_counter()
+        for card_id in card_ids:
+            popularity.record(card_id, delta)
+        select = (time.perf_counter() - started) / SELECTIONS * 1e6
+
+        middle = cards // PAGE_SIZE // 2
+        version = popularity.snapshot()
+        page = p50(popularity.page, middle, PAGE_SIZE, version) * 1000
+        sql = p50(lambda: db.run_sync(sql_page, middle))
+        expected = popularity.page(middle, PAGE_SIZE, version)
+        db.run_sync(lambda cursor: cursor.executemany(
+            'INSERT INTO card_stats (card_id, selection_count, popularity) VALUES (?, 1, ?) '
+            'ON CONFLICT(card_id) DO UPDATE SET popularity = card_stats.popularity + excluded.popularity',
+            ((card_id, delta) for card_id in card_ids)))
+        same = "" if db.run_sync(sql_page, middle) == expected else "  (pages differ!)"
+
+        # A first page after the order changed copies it into a snapshot.
+        def reorder_and_snapshot():
+            popularity.record(random.randint(1, cards), delta * SELECTIONS)
+            return popularity.snapshot()
+        snapshot = p50(reorder_and_snapshot) * 1000
+        print(f"{cards:>8} {read:>8.2f} {sort:>8.2f} {select:>10.2f} {snapshot:>12.2f} {page:>8.2f} "
+              f"{sql:>12.2f}{same}")
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
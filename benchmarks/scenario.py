@@ -0,0 +1,189 @@
+import argparse
+import asyncio
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DATA_DIR = tempfile.mkdtemp()
+os.environ["DATABASE_PATH"] = os.path.join(DATA_DIR, "bench.db")
+os.environ["PHOTOS_ROOT"] = DATA_DIR
+os.environ["METRICS_PORT"] = "0"
+
+from PIL import Image
+
+from fake_bot_api import (FakeBotApi, callback_update, command_update, payment_update, photo_update,
+                          pre_checkout_update, text_update)
+
+# Calls that count as the bot's answer to an update. answerCallbackQuery
+# only stops the button spinner; the answer proper comes after it.
+REPLIES = ("sendMessage", "sendPhoto", "editMessageText", "sendInvoice", "answerPreCheckoutQuery")
+STEPS = ("start", "list", "page", "select", "photo", "name", "buy", "pre_checkout", "payment")
+INVOICE_PAYLOAD = "premium_subscription"
+INVOICE_AMOUNT = 150
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] * 1000
+
+
+def database_size():
+    path = os.environ["DATABASE_PATH"]
+    return sum(os.path.getsize(path + suffix) for suffix in ("", "-wal") if os.path.exists(path + suffix))
+
+
+def make_photo(seed):
+    # A card-like block on a gradient; the seed picks its colour, so photos
+    # with different seeds are not deduplicated.
+    rng = random.Random(seed)
+    image = Image.linear_gradient("L").resize((1280, 960)).convert("RGB")
+    image.paste((rng.randrange(256), rng.randrange(256), rng.randrange(256)), (320, 240, 960, 720))
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=85)
+    return out.getvalue()
+
+
+class Driver:
+    # Plays users through the bot one update at a time: each update goes into
+    # the fake server's getUpdates queue and the next one is sent only once
+    # the bot has answered, the way a person would tap through it.
+    def __init__(self, api, photos):
+        self.api = api
+        self.photos = photos
+        self.latencies = {step: [] for step in STEPS}
+        self.failures = 0
+        self._waiters = {}
+        self._last_reply = {}
+        api.listeners.append(self._on_call)
+
+    def _on_call(self, api_method, params):
+        if api_method not in REPLIES:
+            return
+        if "chat_id" in params:
+            user_id = int(params["chat_id"])
+        else:
+            user_id = int(str(params["pre_checkout_query_id"]).split("-")[0])
+        self._last_reply[user_id] = params
+        waiter = self._waiters.pop(user_id, None)
+        if waiter and not waiter.done():
+            waiter.set_result(time.perf_counter())
+
+    async def _send(self, step, user_id, update, timeout):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[user_id] = waiter
+        started = time.perf_counter()
+        await self.api.push_update(update)
+        try:
+            answered = await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            self._waiters.pop(user_id, None)
+            self.failures += 1
+            return None
+        self.latencies[step].append(answered - started)
+        return self._last_reply.pop(user_id)
+
+    @staticmethod
+    def _buttons(reply):
+        markup = reply.get("reply_markup") or {}
+        return [button["callback_data"] for row in markup.get("inline_keyboard", []) for button in row]
+
+    async def user(self, user_id, timeout):
+        await self._send("start", user_id, command_update(0, user_id, "/start"), timeout)
+
+        reply = await self._send("list", user_id, command_update(0, user_id, "/list"), timeout)
+        buttons = self._buttons(reply) if reply else []
+        next_page = [data for data in buttons if data.startswith("list_")]
+        if next_page:
+            reply = await self._send("page", user_id, callback_update(0, user_id, next_page[-1]), timeout)
+            buttons = self._buttons(reply) if reply else buttons
+        cards = [data for data in buttons if data.startswith("card_")]
+        if cards:
+            await self._send("select", user_id, callback_update(0, user_id, random.choice(cards)), timeout)
+
+        photo = self.api.photo_sizes(random.choice(self.photos))
+        await self._send("photo", user_id, photo_update(0, user_id, photo), timeout)
+        await self._send("name", user_id, text_update(0, user_id, f"Магазин {user_id}"), timeout)
+
+        await self._send("buy", user_id, command_update(0, user_id, "/buy"), timeout)
+        await self._send("pre_checkout", user_id,
+                         pre_checkout_update(0, user_id, INVOICE_PAYLOAD, INVOICE_AMOUNT), timeout)
+        await self._send("payment", user_id, payment_update(0, user_id, INVOICE_PAYLOAD, INVOICE_AMOUNT), timeout)
+
+
+async def seed(api, cards, photos):
+    import repository
+
+    for i in range(cards):
+        file_id = photos[i % len(photos)]
+        await repository.save_card(1, f"Карта {i:05d}", f"photos/seed-{i}.jpg", file_id)
+    await repository.write_buffer.flush()
+
+
+async def run(args):
+    api = FakeBotApi(latency=args.api_latency)
+    await api.start()
+    os.environ["TELEGRAM_API_URL"] = api.url
+    os.environ["CONCURRENT_UPDATES"] = str(args.concurrent_updates)
+    if not args.rate_limits:
+        os.environ["RATE_LIMIT_USER_RATE"] = "0"
+        os.environ["RATE_LIMIT_OUTBOUND_RATE"] = "0"
+
+    import db
+    import main
+
+    photos = [api.add_file(make_photo(seed)) for seed in range(args.photos)]
+    db.create_database()
+    application = main.build_application("123456:TEST")
+    await application.initialize()
+    await application.start()
+    await seed(api, args.cards, photos)
+    size_before = database_size()
+
+    await application.updater.start_polling(poll_interval=0, timeout=1)
+
+    driver = Driver(api, photos)
+    semaphore = asyncio.Semaphore(args.parallel)
+
+    async def user(user_id):
+        async with semaphore:
+            await driver.user(user_id, args.timeout)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(100000 + n) for n in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await api.stop()
+
+    size_after = database_size()
+
+    updates = sum(map(len, driver.latencies.values()))
+    print(f"{args.users} users, {updates} updates answered in {elapsed:.2f} s "
+          f"({updates / elapsed:.0f} updates/s), {driver.failures} unanswered")
+    print(f"{'step':>13} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for step, latencies in driver.latencies.items():
+        if latencies:
+            print(f"{step:>13} {len(latencies):6} {percentile(latencies, 0.5):8.2f} "
+                  f"{percentile(latencies, 0.95):8.2f} {percentile(latencies, 0.99):8.2f}")
+    print(f"database: {size_before / 1024:.0f} KiB -> {size_after / 1024:.0f} KiB "
+          f"(+{(size_after - size_before) / args.users:.0f} bytes per user)")
+    print(f"api calls: {dict(api.calls.most_common())}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Play simulated users through the bot against a fake Bot API.")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--parallel", type=int, default=200, help="users active at the same time")
+    parser.add_argument("--cards", type=int, default=500, help="cards in the catalog before the run")
+    parser.add_argument("--photos", type=int, default=20, help="distinct photos users upload")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="simulated Bot API latency, seconds")
+    parser.add_argument("--concurrent-updates", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for each answer")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the inbound and outbound rate limits")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,102 @@
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+
+import db
+
+USERS = 200_000
+CARDS = 100_000
+REPEAT = 20
+NOW = datetime(2026, 6, 15)
+
+# The statements the new indexes are meant for, with their parameters.
+# {name_match} is how delete_card matched names: LOWER(name) before
+# cards.name_key existed, the key after.
+QUERIES = (
+    ("delete_card lookup", '''
+        SELECT user_id, photo, created_at FROM cards WHERE id = ? OR {name_match}
+    ''', (CARDS // 2, "store 77777")),
+    ("expired premium", '''
+        SELECT user_id FROM premium_users
+        WHERE premium_until < CURRENT_TIMESTAMP AND expiry_notified = 0
+        ORDER BY premium_until LIMIT 100
+    ''', ()),
+    ("active premium", '''
+        SELECT COUNT(*) FROM premium_users WHERE premium_until >= CURRENT_TIMESTAMP
+    ''', ()),
+    ("top cards", '''
+        SELECT c.name, cs.selection_count FROM card_stats cs JOIN cards c ON c.id = cs.card_id
+        ORDER BY cs.selection_count DESC LIMIT 5
+    ''', ()),
+    ("views to archive", '''
+        SELECT month_year, COUNT(*), SUM(views_count) FROM card_views WHERE month_year < ? GROUP BY month_year
+    ''', ("2026-05",)),
+    ("cards per user", 'SELECT user_id, COUNT(*) FROM cards GROUP BY user_id', ()),
+    ("cards per day", 'SELECT DATE(created_at), COUNT(*) FROM cards GROUP BY 1', ()),
+    ("new users per day", 'SELECT DATE(first_use), COUNT(*) FROM users GROUP BY 1', ()),
+)
+
+
+def _timestamp(days_ago):
+    return (NOW - timedelta(days=days_ago, seconds=random.randrange(86400))).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def seed(cursor):
+    random.seed(1)
+    cursor.executemany('INSERT INTO users (user_id, first_use, last_use) VALUES (?, ?, ?)',
+                       ((user_id, _timestamp(random.randrange(365)), _timestamp(random.randrange(30)))
+                        for user_id in range(1, USERS + 1)))
+    cursor.executemany('INSERT INTO cards (id, user_id, name, photo, created_at) VALUES (?, ?, ?, ?, ?)',
+                       ((card_id, random.randrange(1, USERS // 10), f"Store {card_id}", f"photos/{card_id}.jpg",
+                         _timestamp(random.randrange(365))) for card_id in range(1, CARDS + 1)))
+    cursor.executemany('INSERT INTO card_stats (card_id, selection_count) VALUES (?, ?)',
+                       ((card_id, random.randrange(1000)) for card_id in range(1, CARDS + 1)))
+    cursor.executemany('INSERT INTO premium_users (user_id, premium_until, expiry_notified) VALUES (?, ?, ?)',
+                       ((user_id, (datetime.now() + timedelta(days=random.randrange(-400, 30))).isoformat(" "),
+                         int(random.random() < 0.95)) for user_id in range(1, USERS + 1, 2)))
+    cursor.executemany('INSERT INTO card_views (user_id, month_year, views_count) VALUES (?, ?, ?)',
+                       ((user_id, f"2026-{month:02d}", random.randrange(1, 6))
+                        for user_id in range(1, USERS + 1, 3) for month in range(1, 7)))
+
+
+def measure(label, name_match):
+    print(f"--- {label}")
+
+    def run(cursor):
+        for name, sql, params in QUERIES:
+            sql = sql.format(name_match=name_match)
+            plan = cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+            timings = []
+            for _ in range(REPEAT):
+                started = time.perf_counter()
+                cursor.execute(sql, params).fetchall()
+                timings.append(time.perf_counter() - started)
+            timings.sort()
+            print(f"{name:>18}: p50 {timings[len(timings) // 2] * 1000:8.2f} ms   "
+                  f"{'; '.join(row[3] for row in plan)}")
+
+    db.run_sync(run)
+
+
+def main():
+    db.create_database(target=1)
+    db.run_sync(seed)
+    db.run_sync(lambda cursor: cursor.execute('ANALYZE'))
+    measure("baseline schema", "LOWER(name) = LOWER(?)")
+
+    started = time.perf_counter()
+    applied = db.create_database()
+    print(f"applied migrations {applied} in {time.perf_counter() - started:.2f} s; "
+          f"again: {db.create_database()}")
+    measure("after migrations", "name_key = ?")
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
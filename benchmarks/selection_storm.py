@@ -0,0 +1,84 @@
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+
+import db
+import repository
+
+CARDS = 200
+USERS = 1000
+SELECTIONS = 5000
+CONCURRENCY = 32
+
+
+def legacy_views(cursor, user_id, month):
+    cursor.execute('''
+        INSERT INTO card_views (user_id, month_year, views_count)
+        VALUES (?, ?, 1)
+        ON CONFLICT(user_id, month_year)
+        DO UPDATE SET views_count = card_views.views_count + 1
+    ''', (user_id, month))
+
+
+def legacy_select(cursor, card_id):
+    cursor.execute('INSERT INTO card_stats (card_id) VALUES (?) ON CONFLICT DO NOTHING', (card_id,))
+    cursor.execute('UPDATE card_stats SET selection_count = selection_count + 1 WHERE card_id = ?', (card_id,))
+    cursor.execute('SELECT photo, file_id FROM cards WHERE id = ?', (card_id,))
+    return cursor.fetchone()
+
+
+async def legacy_selection(user_id, card_id):
+    await db.run(legacy_views, user_id, repository.get_current_month_year())
+    await db.run(legacy_select, card_id)
+
+
+async def buffered_selection(user_id, card_id):
+    await repository.increment_user_views(user_id)
+    await repository.select_card(card_id)
+
+
+async def storm(name, selection):
+    latencies = []
+    commits = db.commit_count()
+
+    async def worker(offset):
+        for _ in range(offset, SELECTIONS, CONCURRENCY):
+            started = time.perf_counter()
+            await selection(random.randrange(USERS), random.randrange(1, CARDS + 1))
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(offset) for offset in range(CONCURRENCY)))
+    await repository.write_buffer.flush()
+    elapsed = time.perf_counter() - started
+    commits = db.commit_count() - commits
+
+    latencies.sort()
+    print(
+        f"{name:>9}: {SELECTIONS / elapsed:7.0f} selections/s  "
+        f"{commits:6} commits ({commits / elapsed:7.0f}/s)  "
+        f"p50 {latencies[len(latencies) // 2] * 1000:6.3f} ms  "
+        f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:6.3f} ms"
+    )
+
+
+async def main():
+    db.create_database()
+    for i in range(CARDS):
+        await repository.save_card(1, f"Store {i}", f"photos/{i}.jpg")
+
+    repository.write_buffer.start()
+    await storm("legacy", legacy_selection)
+    await storm("buffered", buffered_selection)
+    await repository.write_buffer.stop()
+    db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
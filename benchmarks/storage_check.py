@@ -0,0 +1,113 @@
+import asyncio
+import hashlib
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "check.db")
+
+import httpx
+
+from fake_s3 import FakeS3
+
+import db
+import storage
+
+# Runs S3Storage against FakeS3, which checks every request's signature the
+# way S3 does, and then `storage.migrate` from a local photo directory into
+# it. Point S3Storage at MinIO instead by hand if in doubt about FakeS3.
+failures = []
+
+
+def expect(label, actual, expected):
+    status = "ok" if actual == expected else "FAIL"
+    print(f"{status:>4}  {label}: {actual!r}" + ("" if actual == expected else f", expected {expected!r}"))
+    if actual != expected:
+        failures.append(label)
+
+
+async def chunks(content):
+    for start in range(0, len(content), storage.CHUNK_SIZE):
+        yield content[start:start + storage.CHUNK_SIZE]
+
+
+async def status_of(coroutine):
+    try:
+        await coroutine
+    except httpx.HTTPStatusError as exc:
+        return exc.response.status_code
+    return 200
+
+
+async def check_round_trip(s3, fake):
+    content = os.urandom(3 * storage.CHUNK_SIZE + 5)
+    sha256, key, size, _ = await storage._store(s3, chunks(content))
+    expect("stored under its hash", (key, size),
+           (storage.photo_key(hashlib.sha256(content).hexdigest()), len(content)))
+    expect("object uploaded", fake.objects.get(key) == content, True)
+    expect("exists", await s3.exists(key), True)
+    expect("missing key does not exist", await s3.exists(storage.photo_key("0" * 64)), False)
+    expect("streamed back", b"".join([chunk async for chunk in s3.stream(key)]) == content, True)
+
+    puts = fake.calls.get("PUT", 0)
+    await storage._store(s3, chunks(content))
+    expect("same content not uploaded again", fake.calls.get("PUT", 0), puts)
+
+    await s3.delete(key)
+    expect("deleted", await s3.exists(key), False)
+    expect("deleting twice", await status_of(s3.delete(key)), 200)
+    expect("streaming a deleted key", await status_of(s3.stream(key).__anext__()), 404)
+
+    forged = storage.S3Storage(fake.url, fake.bucket, fake.access_key, "wrong secret")
+    expect("wrong secret rejected", await status_of(forged.exists(key)), 403)
+
+
+async def check_migrate(s3, fake):
+    # Photos from before content addressing, under their old names, plus a
+    # card whose file is gone and two cards sharing one photo's content.
+    root = tempfile.mkdtemp()
+    local = storage.LocalStorage(root)
+    os.makedirs(os.path.join(root, storage.PHOTOS_DIR))
+    photos = {"photos/1_a.jpg": b"first", "photos/2_b.jpg": b"second", "photos/3_c.jpg": b"second"}
+    for path, content in photos.items():
+        with open(os.path.join(root, path), 'wb') as out:
+            out.write(content)
+
+    db.create_database()
+    await db.run(lambda cursor: cursor.executemany('INSERT INTO cards (user_id, name, photo) VALUES (?, ?, ?)',
+                                                   [(1, "Первая", "photos/1_a.jpg"), (2, "Вторая", "photos/2_b.jpg"),
+                                                    (3, "Третья", "photos/3_c.jpg"), (4, "Пропала", "photos/4_d.jpg")]))
+    fake.objects.clear()
+
+    expect("migrated, missing", await storage.migrate(local, s3), (3, 1))
+    db.create_database()
+    cards = await db.fetchall('SELECT photo FROM cards ORDER BY id')
+    keys = [storage.photo_key(hashlib.sha256(content).hexdigest()) for content in photos.values()]
+    expect("cards point at the new keys", [photo for photo, in cards], keys + ["photos/4_d.jpg"])
+    expect("objects in the bucket", sorted(fake.objects), sorted(set(keys)))
+    expect("blob refcounts", await db.fetchall('SELECT path, refcount FROM blobs ORDER BY path'),
+           sorted((key, keys.count(key)) for key in set(keys)))
+    expect("local photos kept", sorted(os.listdir(os.path.join(root, storage.PHOTOS_DIR))),
+           ["1_a.jpg", "2_b.jpg", "3_c.jpg"])
+
+
+async def main():
+    fake = FakeS3()
+    await fake.start()
+    s3 = storage.S3Storage(fake.url, fake.bucket, fake.access_key, fake.secret_key, fake.region)
+    try:
+        await check_round_trip(s3, fake)
+        await check_migrate(s3, fake)
+    finally:
+        await storage.close()
+        db.close()
+        await fake.stop()
+
+    print(f"requests: {fake.calls}")
+    print(f"{len(failures)} failed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
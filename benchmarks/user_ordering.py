@@ -0,0 +1,68 @@
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+from concurrency import serialize_handlers
+from fake_bot_api import FakeBotApi, command_update
+
+USERS = 50
+UPDATES_PER_USER = 40
+MAX_HANDLER_DELAY = 0.005
+
+
+async def main():
+    api = FakeBotApi()
+    await api.start()
+
+    seen = {}
+    handled = asyncio.Event()
+    busy = 0.0
+
+    async def record(update, context):
+        nonlocal busy
+        delay = random.uniform(0, MAX_HANDLER_DELAY)
+        busy += delay
+        await asyncio.sleep(delay)
+        seen.setdefault(update.effective_user.id, []).append(update.update_id)
+        if sum(map(len, seen.values())) == USERS * UPDATES_PER_USER:
+            handled.set()
+
+    application = Application.builder().token("123456:TEST").base_url(f"{api.url}/bot").build()
+    application.add_handler(TypeHandler(Update, record))
+    serialize_handlers(application, limit=16)
+    await application.initialize()
+    await application.start()
+
+    # Interleave users so consecutive updates almost always belong to different users.
+    update_id = 0
+    started = time.perf_counter()
+    for _ in range(UPDATES_PER_USER):
+        for user_id in random.sample(range(1, USERS + 1), USERS):
+            update_id += 1
+            update = Update.de_json(command_update(update_id, user_id, "/start"), application.bot)
+            await application.update_queue.put(update)
+
+    await asyncio.wait_for(handled.wait(), 60)
+    elapsed = time.perf_counter() - started
+
+    await application.stop()
+    await application.shutdown()
+    await api.stop()
+
+    out_of_order = [user_id for user_id, ids in seen.items() if ids != sorted(ids)]
+    print(f"{USERS * UPDATES_PER_USER} updates from {USERS} users in {elapsed:.2f} s "
+          f"(sequential handler time {busy:.2f} s)")
+    print("per-user order preserved" if not out_of_order else f"order violated for users {out_of_order}")
+    if out_of_order:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
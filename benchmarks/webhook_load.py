@@ -0,0 +1,100 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+
+from fake_bot_api import FakeBotApi, command_update
+
+SECRET = "benchmark-secret"
+COMMANDS = ("/myid", "/list", "/info")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] * 1000
+
+
+async def run(args):
+    api = FakeBotApi(latency=args.api_latency)
+    await api.start()
+    os.environ["TELEGRAM_API_URL"] = api.url
+    os.environ["CONCURRENT_UPDATES"] = str(args.concurrent_updates)
+
+    import db
+    import main
+
+    db.create_database()
+    application = main.build_application("123456:TEST")
+    await application.initialize()
+    await application.updater.start_webhook(
+        listen="127.0.0.1",
+        port=args.port,
+        url_path="telegram",
+        secret_token=SECRET,
+        max_connections=args.users,
+    )
+    await application.start()
+
+    pending = {}
+
+    def on_call(api_method, params):
+        if api_method == "sendMessage":
+            waiter = pending.pop(int(params["chat_id"]), None)
+            if waiter and not waiter.done():
+                waiter.set_result(time.perf_counter())
+
+    api.listeners.append(on_call)
+    webhook_url = f"http://127.0.0.1:{args.port}/telegram"
+    ack_latencies = []
+    handler_latencies = []
+    update_ids = iter(range(1, 10 ** 9))
+
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=args.users)) as client:
+        response = await client.post(webhook_url, json=command_update(0, 1, "/myid"),
+                                     headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+        print(f"wrong secret token -> HTTP {response.status_code}")
+
+        async def user(user_id):
+            for i in range(args.updates):
+                waiter = asyncio.get_running_loop().create_future()
+                pending[user_id] = waiter
+                update = command_update(next(update_ids), user_id, COMMANDS[i % len(COMMANDS)])
+
+                started = time.perf_counter()
+                response = await client.post(webhook_url, json=update,
+                                             headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+                response.raise_for_status()
+                ack_latencies.append(time.perf_counter() - started)
+                handler_latencies.append(await asyncio.wait_for(waiter, 30) - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user(1000 + n) for n in range(args.users)))
+        elapsed = time.perf_counter() - started
+
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await api.stop()
+
+    total = args.users * args.updates
+    print(f"{total} updates from {args.users} users, concurrent_updates={args.concurrent_updates}")
+    print(f"throughput: {total / elapsed:.0f} updates/s")
+    print(f"webhook ack: p50 {percentile(ack_latencies, 0.5):.2f} ms  p99 {percentile(ack_latencies, 0.99):.2f} ms")
+    print(f"handler:     p50 {percentile(handler_latencies, 0.5):.2f} ms  p99 {percentile(handler_latencies, 0.99):.2f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay synthetic updates against the webhook endpoint.")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--updates", type=int, default=20, help="updates per user")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--concurrent-updates", type=int, default=16)
+    parser.add_argument("--api-latency", type=float, default=0.02, help="simulated Bot API latency, seconds")
+    asyncio.run(run(parser.parse_args()))
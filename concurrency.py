@@ -0,0 +1,65 @@
+import asyncio
+import functools
+
+
+def _ordering_key(update):
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class UserSerializer:
+    # Handlers are registered with block=False, so PTB turns every callback into
+    # its own task in the order updates arrive. Each task takes its user's lock
+    # before its first await; asyncio locks are FIFO, so one user's updates run
+    # strictly in order while different users proceed in parallel, at most
+    # `limit` at a time.
+    def __init__(self, limit=0):
+        self.limit = limit
+        self._semaphore = None
+        self._locks = {}
+        self._pending = {}
+
+    def wrap(self, callback):
+        @functools.wraps(callback)
+        async def serialized(update, context):
+            key = _ordering_key(update)
+            if key is None:
+                return await self._limited(callback, update, context)
+
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = asyncio.Lock()
+            self._pending[key] = self._pending.get(key, 0) + 1
+            try:
+                async with lock:
+                    return await self._limited(callback, update, context)
+            finally:
+                self._pending[key] -= 1
+                if not self._pending[key]:
+                    del self._pending[key]
+                    del self._locks[key]
+
+        return serialized
+
+    async def _limited(self, callback, update, context):
+        if not self.limit:
+            return await callback(update, context)
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        async with self._semaphore:
+            return await callback(update, context)
+
+    def active_users(self):
+        return len(self._locks)
+
+
+def serialize_handlers(application, limit=0):
+    serializer = UserSerializer(limit)
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = serializer.wrap(handler.callback)
+            handler.block = False
+    return serializer
@@ -0,0 +1,494 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+
+import metrics
+import ranking
+import stats
+
+DATABASE_PATH = environ.get("DATABASE_PATH", os.path.join("data", "discount_cards.db"))
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA foreign_keys = ON",
+)
+
+# DATABASE_URL=postgresql://... moves everything to PostgreSQL, so several bot
+# replicas can share one database; without it the SQLite file is used.
+DATABASE_URL = environ.get("DATABASE_URL")
+DIALECT = 'postgres' if DATABASE_URL else 'sqlite'
+
+_backend = None
+# Totals over every call, for the metrics endpoint. PostgreSQL runs calls on
+# several threads at once, so they are only updated under the lock; each call
+# counts its own statements and adds them when it is done.
+_totals_lock = threading.Lock()
+_statements_executed = 0
+_commits = 0
+
+
+def _record_call(statements, committed):
+    global _statements_executed, _commits
+    with _totals_lock:
+        _statements_executed += statements
+        _commits += committed
+
+
+def statement_count():
+    return _statements_executed
+
+
+def commit_count():
+    return _commits
+
+
+def connect(path=DATABASE_PATH):
+    conn = sqlite3.connect(path, check_same_thread=False, cached_statements=256)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class SQLiteBackend:
+    # SQLite allows a single writer, so every query goes through one
+    # long-lived connection owned by a dedicated thread. Handlers await the
+    # result instead of blocking the event loop.
+    dialect = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        self._connection = None
+        self._statements = 0
+
+    def _count_statement(self, statement):
+        self._statements += 1
+
+    def _get_connection(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = connect(self.path)
+            self._connection.set_trace_callback(self._count_statement)
+        return self._connection
+
+    def call(self, func, args):
+        # Returns the result and the number of statements it took.
+        conn = self._get_connection()
+        self._statements = 0
+        committed = False
+        try:
+            result = func(conn.cursor(), *args)
+        except Exception:
+            conn.rollback()
+            raise
+        else:
+            if conn.in_transaction:
+                conn.commit()
+                committed = True
+        finally:
+            _record_call(self._statements, committed)
+        return result, self._statements
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        if DIALECT == 'postgres':
+            import postgres
+            _backend = postgres.PostgresBackend(DATABASE_URL)
+        else:
+            _backend = SQLiteBackend(DATABASE_PATH)
+    return _backend
+
+
+async def run(func, *args):
+    backend = get_backend()
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    result, statements = await loop.run_in_executor(backend.executor, backend.call, func, args)
+    metrics.record_db_call(statements, time.perf_counter() - started)
+    return result
+
+
+def run_sync(func, *args):
+    backend = get_backend()
+    return backend.executor.submit(backend.call, func, args).result()[0]
+
+
+async def fetchone(sql, params=()):
+    return await run(lambda cursor: cursor.execute(sql, params).fetchone())
+
+
+async def fetchall(sql, params=()):
+    return await run(lambda cursor: cursor.execute(sql, params).fetchall())
+
+
+async def execute(sql, params=()):
+    return await run(lambda cursor: cursor.execute(sql, params).rowcount)
+
+
+def close():
+    # Safe to call more than once; the next query opens a fresh backend.
+    global _backend
+    backend, _backend = _backend, None
+    if backend is not None:
+        backend.executor.submit(backend.close).result()
+        backend.executor.shutdown()
+
+
+# SQL fragments whose spelling differs between the backends.
+
+def date_of(expression):
+    if DIALECT == 'postgres':
+        return f"CAST({expression} AS DATE)"
+    return f"DATE({expression})"
+
+
+def days_between(later, earlier):
+    if DIALECT == 'postgres':
+        return f"EXTRACT(EPOCH FROM {later} - {earlier}) / 86400"
+    return f"JULIANDAY({later}) - JULIANDAY({earlier})"
+
+
+def normalize_name(name):
+    return name.strip().lower()
+
+
+def normalize_search(text):
+    return normalize_name(text).replace('ё', 'е')
+
+
+def _create_schema(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            name TEXT,
+            photo TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            first_use TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_use TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS card_stats (
+            card_id INTEGER PRIMARY KEY,
+            selection_count INTEGER DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS premium_users (
+            user_id INTEGER PRIMARY KEY,
+            premium_until TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS card_views (
+            user_id INTEGER,
+            month_year TEXT,
+            views_count INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, month_year)
+        )
+    ''')
+    cursor.execute('PRAGMA table_info(cards)')
+    card_columns = {row[1] for row in cursor.fetchall()}
+    if 'file_id' not in card_columns:
+        cursor.execute('ALTER TABLE cards ADD COLUMN file_id TEXT')
+    if 'barcode' not in card_columns:
+        cursor.execute('ALTER TABLE cards ADD COLUMN barcode TEXT')
+        cursor.execute('ALTER TABLE cards ADD COLUMN barcode_format TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cards_barcode ON cards (barcode)')
+
+    cursor.execute('PRAGMA table_info(premium_users)')
+    if 'expiry_notified' not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute('ALTER TABLE premium_users ADD COLUMN expiry_notified INTEGER NOT NULL DEFAULT 0')
+        mark_lapsed_premium_notified(cursor)
+    # card_views months that no longer count towards a quota, one row each.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS card_views_archive (
+            month_year TEXT PRIMARY KEY,
+            users INTEGER NOT NULL,
+            views INTEGER NOT NULL
+        )
+    ''')
+
+    # Latest card per normalized name, maintained by save_card/delete_card so
+    # /list can page over it by card_id without grouping the cards table.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS card_catalog (
+            name_key TEXT PRIMARY KEY,
+            card_id INTEGER NOT NULL UNIQUE,
+            name TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # PTB user_data/chat_data as JSON, written by persistence.SQLitePersistence.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_data (
+            kind TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, id)
+        )
+    ''')
+    cursor.execute('SELECT EXISTS(SELECT 1 FROM card_catalog)')
+    if not cursor.fetchone()[0]:
+        rebuild_catalog(cursor)
+
+    # Trigram full-text index over catalog names, kept in sync by triggers.
+    # It is contentless: the indexed text is the normalized name with ё folded
+    # into е, which is also how search queries are normalized.
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS card_search
+        USING fts5(name, content='', tokenize='trigram')
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS card_catalog_search_insert AFTER INSERT ON card_catalog BEGIN
+            INSERT INTO card_search (rowid, name) VALUES (new.card_id, REPLACE(new.name_key, 'ё', 'е'));
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS card_catalog_search_delete AFTER DELETE ON card_catalog BEGIN
+            INSERT INTO card_search (card_search, rowid, name)
+            VALUES ('delete', old.card_id, REPLACE(old.name_key, 'ё', 'е'));
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS card_catalog_search_update AFTER UPDATE ON card_catalog BEGIN
+            INSERT INTO card_search (card_search, rowid, name)
+            VALUES ('delete', old.card_id, REPLACE(old.name_key, 'ё', 'е'));
+            INSERT INTO card_search (rowid, name) VALUES (new.card_id, REPLACE(new.name_key, 'ё', 'е'));
+        END
+    ''')
+    cursor.execute('SELECT EXISTS(SELECT 1 FROM card_search)')
+    if not cursor.fetchone()[0]:
+        cursor.execute('''
+            INSERT INTO card_search (rowid, name)
+            SELECT card_id, REPLACE(name_key, 'ё', 'е') FROM card_catalog
+        ''')
+
+    stats.create_tables(cursor)
+
+
+def rebuild_catalog(cursor):
+    latest = {}
+    for card_id, name in cursor.execute('SELECT id, name FROM cards WHERE name IS NOT NULL ORDER BY id'):
+        latest[normalize_name(name)] = (card_id, name)
+
+    cursor.execute('DELETE FROM card_catalog')
+    cursor.executemany('''
+        INSERT INTO card_catalog (name_key, card_id, name) VALUES (?, ?, ?)
+    ''', ((name_key, card_id, name) for name_key, (card_id, name) in latest.items()))
+
+
+def mark_lapsed_premium_notified(cursor):
+    # Subscriptions that lapsed before expiry_notified existed were never
+    # announced and should not all be at once after the upgrade.
+    cursor.execute('UPDATE premium_users SET expiry_notified = 1 WHERE premium_until < CURRENT_TIMESTAMP')
+
+
+def fill_name_keys(cursor):
+    # cards.name_key is normalize_name(name), computed in Python: SQLite's
+    # LOWER() only folds ASCII, so it cannot match Cyrillic names by key.
+    cursor.execute('SELECT id, name FROM cards WHERE name_key IS NULL AND name IS NOT NULL')
+    cursor.executemany('UPDATE cards SET name_key = ? WHERE id = ?',
+                       [(normalize_name(name), card_id) for card_id, name in cursor.fetchall()])
+
+
+def _add_indexes(cursor):
+    # What the remaining queries filter, group and sort on. The DATE() and
+    # LOWER() expressions are the ones stats.rebuild and delete_card use, so
+    # the planner can match them. users.last_use is left alone: it is
+    # rewritten on every touch and only the stats rebuild reads it.
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cards_user_id ON cards (user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cards_created_day ON cards (DATE(created_at))')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cards_lower_name ON cards (LOWER(name))')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_first_use_day ON users (DATE(first_use))')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_card_views_month ON card_views (month_year)')
+    # Covers both the active premium count and the expiry job's scan.
+    cursor.execute('DROP INDEX IF EXISTS idx_premium_users_premium_until')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_premium_users_expiry ON premium_users (premium_until, expiry_notified)
+    ''')
+
+
+def _card_stats_foreign_key(cursor):
+    # SQLite cannot add a foreign key to an existing table, so card_stats is
+    # copied into a new one; stats left behind by deleted cards are dropped.
+    cursor.execute('''
+        CREATE TABLE card_stats_new (
+            card_id INTEGER PRIMARY KEY REFERENCES cards (id) ON DELETE CASCADE,
+            selection_count INTEGER DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO card_stats_new (card_id, selection_count)
+        SELECT card_id, selection_count FROM card_stats WHERE card_id IN (SELECT id FROM cards)
+    ''')
+    cursor.execute('DROP TABLE card_stats')
+    cursor.execute('ALTER TABLE card_stats_new RENAME TO card_stats')
+    cursor.execute('CREATE INDEX idx_card_stats_selection_count ON card_stats (selection_count)')
+
+
+def _card_popularity(cursor):
+    # Time-decayed scores for the /list ranking, per card and per user (see
+    # ranking.py). Selections counted so far have no time, so they are
+    # weighted as if they had just been made.
+    cursor.execute('ALTER TABLE card_stats ADD COLUMN popularity REAL NOT NULL DEFAULT 0')
+    cursor.execute('UPDATE card_stats SET popularity = selection_count * ?', (ranking.weight(),))
+    cursor.execute('''
+        CREATE TABLE user_card_selections (
+            user_id INTEGER NOT NULL,
+            card_id INTEGER NOT NULL REFERENCES cards (id) ON DELETE CASCADE,
+            score REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, card_id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX idx_user_card_selections_card_id ON user_card_selections (card_id)')
+
+
+def _card_name_keys(cursor):
+    # delete_card finds every card with a catalog name by this key; the
+    # LOWER(name) index it replaces only matched ASCII names.
+    cursor.execute('ALTER TABLE cards ADD COLUMN name_key TEXT')
+    fill_name_keys(cursor)
+    cursor.execute('DROP INDEX IF EXISTS idx_cards_lower_name')
+    cursor.execute('CREATE INDEX idx_cards_name_key ON cards (name_key)')
+
+
+def move_pending_uploads(cursor):
+    # Pending uploads used to live in user_data, which every replica keeps its
+    # own copy of; they move to pending_uploads with their photo's blob.
+    cursor.execute("SELECT id, data FROM conversation_data WHERE kind = 'user_data'")
+    for user_id, data in cursor.fetchall():
+        user_data = json.loads(data)
+        upload = user_data.pop('pending_upload', None)
+        if not upload:
+            continue
+        barcode = upload.get('barcode') or (None, None)
+        cursor.execute('''
+            INSERT INTO pending_uploads (user_id, photo, file_id, barcode, barcode_format, uploaded_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO NOTHING
+        ''', (user_id, upload['photo_path'], upload.get('file_id'), *barcode, upload['uploaded_at']))
+        if user_data:
+            cursor.execute('''
+                UPDATE conversation_data SET data = ? WHERE kind = 'user_data' AND id = ?
+            ''', (json.dumps(user_data, ensure_ascii=False, sort_keys=True), user_id))
+        else:
+            cursor.execute("DELETE FROM conversation_data WHERE kind = 'user_data' AND id = ?", (user_id,))
+
+
+def _pending_uploads(cursor):
+    # A photo waiting for its name, one per user. uploaded_at is a Unix time.
+    cursor.execute('''
+        CREATE TABLE pending_uploads (
+            user_id INTEGER PRIMARY KEY,
+            photo TEXT NOT NULL,
+            file_id TEXT,
+            barcode TEXT,
+            barcode_format TEXT,
+            uploaded_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX idx_pending_uploads_uploaded_at ON pending_uploads (uploaded_at)')
+    move_pending_uploads(cursor)
+
+
+def _card_search_prefix(cursor):
+    # For the short-query prefix match in repository._search_cards, which
+    # folds ё to е on the key as normalize_search does on the query.
+    cursor.execute("CREATE INDEX idx_card_catalog_search_prefix ON card_catalog (REPLACE(name_key, 'ё', 'е'))")
+
+
+# Applied in order, each once, and recorded in schema_version. The baseline
+# also brings databases from before versioning up to date, so it is safe to
+# run over them.
+MIGRATIONS = (
+    (1, "baseline schema", _create_schema),
+    (2, "query indexes", _add_indexes),
+    (3, "card_stats cascades from cards", _card_stats_foreign_key),
+    (4, "decayed card popularity", _card_popularity),
+    (5, "cards.name_key", _card_name_keys),
+    (6, "pending uploads table", _pending_uploads),
+    (7, "folded card name prefix index", _card_search_prefix),
+)
+
+
+def _migrate(cursor, target=None):
+    migrations = MIGRATIONS
+    if DIALECT == 'postgres':
+        import postgres
+        migrations = postgres.MIGRATIONS
+        # Replicas starting together would otherwise race to apply the same
+        # step; the others wait here and then find nothing pending.
+        cursor.execute('SELECT pg_advisory_lock(?)', (postgres.MIGRATION_LOCK,))
+    try:
+        return _apply_migrations(cursor, migrations, target)
+    finally:
+        if DIALECT == 'postgres':
+            # The lock belongs to the pooled connection, not the transaction,
+            # so it is released even when a step failed.
+            cursor.connection.rollback()
+            cursor.execute('SELECT pg_advisory_unlock(?)', (postgres.MIGRATION_LOCK,))
+
+
+def _apply_migrations(cursor, migrations, target):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    applied = {row[0] for row in cursor.execute('SELECT version FROM schema_version')}
+    pending = [
+        (version, description, migration) for version, description, migration in migrations
+        if version not in applied and (target is None or version <= target)
+    ]
+    for version, description, migration in pending:
+        migration(cursor)
+        cursor.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)', (version, description))
+        cursor.connection.commit()
+    if pending:
+        # Fresh statistics, so the planner weighs the new indexes properly.
+        cursor.execute('ANALYZE')
+        cursor.connection.commit()
+    return [version for version, _, _ in pending]
+
+
+def create_database(target=None):
+    # Brings the schema up to `target`, the latest version by default, and
+    # returns the versions that were applied.
+    return run_sync(_migrate, target)
@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from os import environ
+
+from PIL import Image, ImageFilter, ImageOps
+
+try:
+    import zxingcpp
+except ImportError:
+    zxingcpp = None
+
+MAX_SIDE = 1280
+JPEG_QUALITY = 82
+CROP_MARGIN = 0.04
+CROP_PREVIEW_SIDE = 256
+EDGE_THRESHOLD = 48
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # Spawned rather than forked, so workers start clean instead of
+        # inheriting the database thread and its connection.
+        workers = int(environ.get("IMAGE_WORKERS", "0")) or None
+        _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def choose_photo_size(sizes):
+    # Telegram sends every resolution it has; the smallest one that still
+    # covers MAX_SIDE is enough and is cheaper to download than the largest.
+    for size in sizes:
+        if max(size.width, size.height) >= MAX_SIDE:
+            return size
+    return sizes[-1]
+
+
+def _crop_to_content(image):
+    # A card is a high-contrast object on a usually flatter background: keep
+    # the bounding box of strong edges plus a small margin. Edges are found on
+    # a small blurred copy, which also keeps sensor noise out of them, and the
+    # edge filter's own response along the image border is cut off.
+    width = CROP_PREVIEW_SIDE
+    height = max(CROP_PREVIEW_SIDE * image.height // image.width, 8)
+    edges = (image.convert("L").resize((width, height), Image.BOX)
+             .filter(ImageFilter.GaussianBlur(1)).filter(ImageFilter.FIND_EDGES)
+             .crop((2, 2, width - 2, height - 2)))
+    box = edges.point(lambda value: 255 if value > EDGE_THRESHOLD else 0).getbbox()
+    if box is None:
+        return image
+
+    scale_x, scale_y = image.width / width, image.height / height
+    margin = int(max(image.size) * CROP_MARGIN)
+    left, top, right, bottom = box
+    box = (max(int((left + 2) * scale_x) - margin, 0), max(int((top + 2) * scale_y) - margin, 0),
+           min(int((right + 2) * scale_x) + margin, image.width), min(int((bottom + 2) * scale_y) + margin, image.height))
+    # A box that keeps almost everything is not worth a crop.
+    if (box[2] - box[0]) * (box[3] - box[1]) > 0.9 * image.width * image.height:
+        return image
+    return image.crop(box)
+
+
+def _decode(image):
+    # The first readable barcode or QR code as (text, format), or None when
+    # there is none or zxing-cpp is not installed.
+    if zxingcpp is None:
+        return None
+    for barcode in zxingcpp.read_barcodes(image):
+        if barcode.valid and barcode.text:
+            return barcode.text, barcode.format.name
+    return None
+
+
+def decode_file(path):
+    with Image.open(path) as image:
+        return _decode(ImageOps.exif_transpose(image).convert("RGB"))
+
+
+def normalize_file(source_path, target_path, enhance=False):
+    # Runs in a worker process. Writes a downscaled, recompressed JPEG and
+    # returns its sha256, size and decoded barcode, so the event loop never
+    # reads the image back.
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        if enhance:
+            image = _crop_to_content(image)
+        image.thumbnail((MAX_SIDE, MAX_SIDE), Image.LANCZOS)
+        if enhance:
+            image = ImageOps.autocontrast(image, cutoff=1)
+        barcode = _decode(image)
+        image.save(target_path, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+
+    digest = hashlib.sha256()
+    with open(target_path, 'rb') as target:
+        while chunk := target.read(64 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest(), os.path.getsize(target_path), barcode
+
+
+async def normalize(source_path, target_path, enhance=None):
+    if enhance is None:
+        enhance = environ.get("IMAGE_ENHANCE", "0") == "1"
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), normalize_file, source_path, target_path, enhance)
+
+
+async def decode(path):
+    if zxingcpp is None:
+        return None
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), decode_file, path)
+
+
+def close():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
@@ -1,108 +1,46 @@
-from telegram import LabeledPrice, Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
+from telegram import LabeledPrice, Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, Message, \
+    InlineQueryResultCachedPhoto, InlineQueryResultsButton
+from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, ContextTypes, PreCheckoutQueryHandler, MessageHandler, filters, \
-    CallbackQueryHandler
-import sqlite3
-import os
-import time
+    CallbackQueryHandler, InlineQueryHandler
+import asyncio
+import html
+import tempfile
 from os import environ
 from datetime import datetime, timedelta
 import textwrap
 
-DATABASE_PATH = os.path.join("data", "discount_cards.db")
-
-def create_database():
-    os.makedirs("data", exist_ok=True)
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS cards (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            name TEXT,
-            photo TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            first_use TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_use TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS card_stats (
-            card_id INTEGER PRIMARY KEY,
-            selection_count INTEGER DEFAULT 0
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS premium_users (
-            user_id INTEGER PRIMARY KEY,
-            premium_until TIMESTAMP
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS card_views (
-            user_id INTEGER,
-            month_year TEXT,
-            views_count INTEGER DEFAULT 0,
-            PRIMARY KEY (user_id, month_year)
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-create_database()
-
-def has_premium_access(user_id):
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT premium_until FROM premium_users WHERE user_id = ? AND premium_until >= CURRENT_TIMESTAMP
-    ''', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
-
-def was_premium_access(user_id):
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT premium_until FROM premium_users WHERE user_id = ?
-    ''', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
-
-def update_user_stats(user_id):
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR IGNORE INTO users (user_id) VALUES (?)
-    ''', (user_id,))
-    cursor.execute('''
-        UPDATE users SET last_use = CURRENT_TIMESTAMP WHERE user_id = ?
-    ''', (user_id,))
-    conn.commit()
-    conn.close()
-
-def add_premium(user_id, premium_until):
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-            INSERT OR REPLACE INTO premium_users (user_id, premium_until) VALUES (?, ?)
-        ''', (user_id, premium_until))
-    conn.commit()
-    conn.close()
+from db import create_database
+import db
+import backup
+import images
+import maintenance
+import storage
+import metrics
+import ratelimit
+from concurrency import serialize_handlers
+from persistence import SQLitePersistence
+from repository import has_premium_access, was_premium_access, update_user_stats, add_premium, \
+    get_access_context, increment_user_views, save_card, select_card, collect_stats
+import repository
+from cache import MISSING, TTLCache
+
+PAGE_SIZE = 10
+PAGE_CACHE_SIZE = 1000
+PAGE_CACHE_TTL = 3600
+# How many of a user's own most selected cards head their first /list page;
+# 0 shows everyone the same list.
+PERSONAL_CARDS = int(environ.get("RANKING_PERSONAL_CARDS", "3"))
+
+page_cache = TTLCache(PAGE_CACHE_SIZE, PAGE_CACHE_TTL)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     premium_until = datetime.now() + timedelta(days=30)
 
-    update_user_stats(user_id)
-    if not was_premium_access(user_id):
-        add_premium(user_id, premium_until)
+    await update_user_stats(user_id)
+    if not await was_premium_access(user_id):
+        await add_premium(user_id, premium_until)
 
     welcome_text = textwrap.dedent("""
     🌟 *Добро пожаловать в клуб обмена персональными скидками!* 🌟
@@ -120,6 +58,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     📌 *Доступные команды:*
     - */start* - показать это сообщение
     - */list* - список доступных карт
+    - */find* - найти карту по названию
     - */load* - загрузить карту
     """).strip()
     await update.message.reply_text(welcome_text, parse_mode="Markdown")
@@ -133,6 +72,7 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     📌 *Доступные команды:*
     - */start* - показать это сообщение
     - */list* - список доступных карт
+    - */find* - найти карту по названию
     - */load* - загрузить карту
     """).strip()
     await update.message.reply_text(info_text, parse_mode="Markdown")
@@ -166,63 +106,69 @@ async def pre_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     premium_until = datetime.now() + timedelta(days=30)
-    add_premium(user_id, premium_until)
+    await add_premium(user_id, premium_until)
     await update.message.reply_text("🎉 Спасибо за оплату! Ваш премиум-доступ активирован на 1 месяц.")
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
 
-    if not has_premium_access(user_id):
+    if not await has_premium_access(user_id):
         await update.message.reply_text("❌ Для загрузки карт необходим премиум-доступ. Используйте команду /buy.")
         return
 
-    update_user_stats(user_id)
+    await update_user_stats(user_id)
 
-    timestamp = int(time.time())
-    photo_path = f"photos/{user_id}_{timestamp}.jpg"
+    photo = images.choose_photo_size(update.message.photo)
+    photo_file = await photo.get_file()
+    sha256, photo_path, size, barcode = await storage.store_photo(photo_file)
+    await repository.register_blob(sha256, photo_path, size)
 
-    photo_file = await update.message.photo[-1].get_file()
-    os.makedirs("photos", exist_ok=True)
-    await photo_file.download_to_drive(photo_path)
+    # A card is identified by its number when one can be read: uploading the
+    # same number again refreshes the existing card instead of asking for a name.
+    existing_card = await repository.find_card_by_barcode(barcode[0]) if barcode else None
+    if existing_card:
+        file_id = await confirm_upload(update.message, photo_path, photo.file_id,
+                                       f"✅ Карта с этим номером уже есть: '{existing_card[1]}'. Фотография обновлена.")
+        await save_card(user_id, existing_card[1], photo_path, file_id, barcode)
+        return
 
-    context.user_data['photo_path'] = photo_path
+    file_id = await confirm_upload(update.message, photo_path, photo.file_id,
+                                   "📸 Фотография сохранена. Теперь отправьте имя для этой карты.")
+    await repository.set_pending_upload(user_id, photo_path, file_id, barcode)
 
-    await update.message.reply_text("📸 Фотография сохранена. Теперь отправьте имя для этой карты.")
+async def confirm_upload(message: Message, photo_path: str, file_id: str, text: str):
+    # Under the received photo's file_id Telegram keeps the original, not the
+    # normalized copy in storage. That copy is sent back once as the
+    # confirmation, and its file_id is the one the card is delivered with.
+    if not storage.normalizes_photos():
+        await message.reply_text(text)
+        return file_id
+    sent = await message.reply_photo(await storage.read_photo(photo_path), caption=text)
+    return sent.photo[-1].file_id
 
 async def handle_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
 
-    if not has_premium_access(user_id):
+    if not await has_premium_access(user_id):
         await update.message.reply_text("❌ Для загрузки карт необходим премиум-доступ. Используйте команду /buy.")
         return
 
+    pending_upload = await repository.take_pending_upload(user_id)
+    if not pending_upload:
+        await update.message.reply_text("📸 Сначала отправьте фотографию карты, а затем её название.")
+        return
+
     name = update.message.text.strip()
-    name_lower = name.lower()
 
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM cards WHERE LOWER(name) = ?', (name_lower,))
-    existing_card = cursor.fetchone()
+    photo_path, file_id, barcode = pending_upload
+    created = await save_card(user_id, name, photo_path, file_id, barcode)
 
-    if existing_card:
-        card_id = existing_card[0]
-        cursor.execute('''
-            UPDATE cards
-            SET user_id = ?, photo = ?
-            WHERE id = ?
-        ''', (user_id, context.user_data['photo_path'], card_id))
-        await update.message.reply_text(f"✅ Карта '{name}' обновлена.")
-    else:
-        cursor.execute('''
-            INSERT INTO cards (user_id, name, photo)
-            VALUES (?, ?, ?)
-        ''', (user_id, name, context.user_data['photo_path']))
+    if created:
         await update.message.reply_text(f"✅ Имя '{name}' успешно присвоено вашей карте.")
+    else:
+        await update.message.reply_text(f"✅ Карта '{name}' обновлена.")
 
-    conn.commit()
-    conn.close()
-
-async def list_cards(update_or_query, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
+async def list_cards(update_or_query, context: ContextTypes.DEFAULT_TYPE, page: int = 0, version: int = None):
     if isinstance(update_or_query, CallbackQuery):
         user_id = update_or_query.from_user.id
         send_method = update_or_query.edit_message_text
@@ -230,60 +176,121 @@ async def list_cards(update_or_query, context: ContextTypes.DEFAULT_TYPE, page:
         user_id = update_or_query.from_user.id
         send_method = update_or_query.reply_text
 
-    if not can_view_more_cards(user_id):
-        remaining_views = 5 - get_user_monthly_views(user_id)
+    access = await get_access_context(user_id)
+    if not access.can_view:
         await send_method(
-            f"❌ Вы достигли лимита просмотров карт на этот месяц ({5 - remaining_views}/5).\n"
+            f"❌ Вы достигли лимита просмотров карт на этот месяц ({access.monthly_views}/5).\n"
             "Для неограниченного доступа к картам используйте команду /buy"
         )
         return
 
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, name FROM cards
-        WHERE id IN (SELECT MAX(id) FROM cards GROUP BY LOWER(name))
-        LIMIT 10 OFFSET ?
-    ''', (page * 10,))
-    cards = cursor.fetchall()
-    conn.close()
-
-    if not cards:
+    favorites = await repository.get_favorite_cards(user_id, PERSONAL_CARDS) if page == 0 and PERSONAL_CARDS else []
+    render = await render_cards_page(page, favorites, version)
+    if render is None:
         await send_method("📭 Больше карт нет.")
         return
 
-    keyboard = [
-        [InlineKeyboardButton(card[1], callback_data=f"card_{card[0]}")] for card in cards
-    ]
-
-    nav_buttons = []
-    if page > 0:
-        nav_buttons.append(InlineKeyboardButton("← Назад", callback_data=f"list_{page - 1}"))
-    if len(cards) == 10:
-        nav_buttons.append(InlineKeyboardButton("Вперед →", callback_data=f"list_{page + 1}"))
-
-    if nav_buttons:
-        keyboard.append(nav_buttons)
-
-    remaining_views = 5 - get_user_monthly_views(user_id)
-    views_info = f"\n\n👁 Осталось просмотров в этом месяце: {remaining_views}/5" if not has_premium_access(user_id) else ""
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await send_method(
-        f"📋 Страница {page + 1}. Выберите карту:{views_info}",
-        reply_markup=reply_markup
-    )
+    text, reply_markup = render
+    views_info = f"\n\n👁 Осталось просмотров в этом месяце: {access.remaining_views}/5" if not access.is_premium else ""
+    await send_method(f"{text}{views_info}", reply_markup=reply_markup)
+
+async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await list_cards(update.message, context, page=0)
+
+async def render_cards_page(page: int, favorites=(), version: int = None):
+    # Pages are slices of a snapshot of the popularity ranking, and the page
+    # buttons carry its version, so paging through one /list stays on one
+    # order. A render is cached per snapshot and the cards left on the page,
+    # so a card deleted since the snapshot drops out of its buttons; renders
+    # of old snapshots age out of the LRU. A first page headed by the user's
+    # own favorites is theirs alone and is not cached.
+    page = max(page, 0)
+    version, cards = await repository.get_ranked_page(page, PAGE_SIZE, version)
+    key = (version, page, tuple(card_id for card_id, _ in cards))
+    render = page_cache.get(key) if not favorites else MISSING
+    if render is not MISSING:
+        return render
+
+    render = None
+    if cards:
+        favorite_ids = {card_id for card_id, _ in favorites}
+        keyboard = [
+            [InlineKeyboardButton(f"⭐ {name}", callback_data=f"card_{card_id}")] for card_id, name in favorites
+        ] + [
+            [InlineKeyboardButton(card[1], callback_data=f"card_{card[0]}")]
+            for card in cards if card[0] not in favorite_ids
+        ]
+
+        nav_buttons = []
+        if page > 0:
+            nav_buttons.append(InlineKeyboardButton("← Назад", callback_data=f"list_{page - 1}_v{version}"))
+        if len(cards) == PAGE_SIZE:
+            nav_buttons.append(InlineKeyboardButton("Вперед →", callback_data=f"list_{page + 1}_v{version}"))
+
+        if nav_buttons:
+            keyboard.append(nav_buttons)
+
+        render = (f"📋 Страница {page + 1}. Выберите карту:", InlineKeyboardMarkup(keyboard))
+
+    if not favorites:
+        page_cache.set(key, render)
+    return render
 
 async def handle_list_pagination(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
     if query.data.startswith("list_"):
-        page = int(query.data.split("_")[1])
-        await list_cards(query, context, page)
+        # list_<page>_v<snapshot>. Buttons from before the ranking carry a
+        # keyset cursor instead, and plain list_<page> ones nothing; both get
+        # the current order.
+        parts = query.data.split("_")
+        version = int(parts[2][1:]) if len(parts) > 2 and parts[2].startswith("v") else None
+        await list_cards(query, context, int(parts[1]), version)
+    elif query.data.startswith("photo_"):
+        await handle_card_photo(update, context)
     else:
         await handle_card_selection(update, context)
 
+async def find_cards(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        await update.message.reply_text("🔍 Используйте команду так: /find <название карты>")
+        return
+
+    query = " ".join(context.args)
+    cards = await repository.search_cards(query)
+
+    if not cards:
+        await update.message.reply_text(f"📭 По запросу '{query}' ничего не найдено.")
+        return
+
+    keyboard = [
+        [InlineKeyboardButton(card[1], callback_data=f"card_{card[0]}")] for card in cards
+    ]
+    await update.message.reply_text(
+        f"🔍 Результаты поиска по запросу '{query}':",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+
+    if not await has_premium_access(query.from_user.id):
+        await query.answer(
+            [],
+            cache_time=60,
+            is_personal=True,
+            button=InlineQueryResultsButton("💎 Поиск карт доступен с премиумом", start_parameter="premium"),
+        )
+        return
+
+    cards = await repository.search_cards(query.query, limit=20)
+    results = [
+        InlineQueryResultCachedPhoto(id=str(card_id), photo_file_id=file_id, title=name, caption=name)
+        for card_id, name, file_id in cards if file_id
+    ]
+    await query.answer(results, cache_time=60, is_personal=True)
+
 async def my_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     await update.message.reply_text(f"🆔 Ваш user_id: {user_id}")
@@ -303,13 +310,7 @@ async def grant_premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     premium_until = datetime.now() + timedelta(days=30)
 
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR REPLACE INTO premium_users (user_id, premium_until) VALUES (?, ?)
-    ''', (user_id, premium_until))
-    conn.commit()
-    conn.close()
+    await add_premium(user_id, premium_until)
 
     await update.message.reply_text(f"🎉 Пользователю с user_id {user_id} выдан премиум-доступ на 1 месяц.")
 
@@ -326,24 +327,10 @@ async def delete_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Неверный пароль.")
         return
 
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT id FROM cards WHERE LOWER(name) = LOWER(?)', (card_name,))
-    card = cursor.fetchone()
-
-    if not card:
+    if not await repository.delete_card(card_name):
         await update.message.reply_text(f"❌ Карта '{card_name}' не найдена.")
-        conn.close()
         return
 
-    cursor.execute('DELETE FROM cards WHERE LOWER(name) = LOWER(?)', (card_name,))
-    conn.commit()
-
-    cursor.execute('DELETE FROM card_stats WHERE card_id = ?', (card[0],))
-    conn.commit()
-    conn.close()
-
     await update.message.reply_text(f"✅ Карта '{card_name}' удалена.")
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -358,109 +345,54 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Неверный пароль.")
         return
 
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT COUNT(*) FROM users')
-    total_users = cursor.fetchone()[0]
-
-    cursor.execute('SELECT COUNT(DISTINCT user_id) FROM cards')
-    users_with_cards = cursor.fetchone()[0]
-
-    cursor.execute('SELECT COUNT(*) FROM cards')
-    total_cards = cursor.fetchone()[0]
-
-    avg_cards_per_user = total_cards / users_with_cards if users_with_cards > 0 else 0
-
-    retention_period = 7
-    retention_date = datetime.now() - timedelta(days=retention_period)
-    cursor.execute('''
-        SELECT COUNT(DISTINCT user_id) FROM users
-        WHERE last_use >= ?
-    ''', (retention_date,))
-    retained_users = cursor.fetchone()[0]
-    retention_rate = (retained_users / total_users) * 100 if total_users > 0 else 0
-
-    cursor.execute('SELECT COUNT(DISTINCT user_id) FROM users WHERE last_use >= DATE("now", "-7 days")')
-    active_users_last_7_days = cursor.fetchone()[0]
-
-    cursor.execute('SELECT COUNT(*) FROM users WHERE first_use >= DATE("now", "-7 days")')
-    new_users_last_7_days = cursor.fetchone()[0]
-
-    conversion_rate = (users_with_cards / total_users) * 100 if total_users > 0 else 0
-
-    cursor.execute('SELECT AVG(JULIANDAY(last_use) - JULIANDAY(first_use)) FROM users')
-    avg_usage_duration = cursor.fetchone()[0] or 0
-
-    cursor.execute('''
-        SELECT c.name, COALESCE(cs.selection_count, 0) as selection_count 
-        FROM cards c
-        LEFT JOIN card_stats cs ON c.id = cs.card_id
-        ORDER BY selection_count DESC
-        LIMIT 5
-    ''')
-    top_cards = cursor.fetchall()
-
-    cursor.execute('SELECT COUNT(*) FROM cards WHERE created_at >= DATE("now", "-7 days")')
-    cards_last_7_days = cursor.fetchone()[0]
-
-    cursor.execute('''
-        SELECT AVG(card_count) 
-        FROM (
-            SELECT user_id, COUNT(*) as card_count 
-            FROM cards 
-            GROUP BY user_id
-        )
-    ''')
-    avg_cards_per_active_user = cursor.fetchone()[0] or 0
-
-    cursor.execute('SELECT COUNT(DISTINCT user_id) FROM premium_users')
-    premium_users = cursor.fetchone()[0]
-
-    premium_conversion = (premium_users / total_users) * 100 if total_users > 0 else 0
-
-    cursor.execute('SELECT COUNT(*) FROM premium_users WHERE premium_until >= CURRENT_TIMESTAMP')
-    active_premium_users = cursor.fetchone()[0]
+    stats = await collect_stats()
 
     stats_text = textwrap.dedent(f"""
         📊 *Статистика использования бота:*
 
-        👤 *Всего пользователей:* {total_users}
-        📂 *Пользователей с картами:* {users_with_cards}
-        💎 Пользователей с премиумом: {premium_users}
-        🚀 Конверсия в премиум: {premium_conversion:.2f}%
-        💎 Активных премиум-подписок: {active_premium_users}
+        👤 *Всего пользователей:* {stats['total_users']}
+        📂 *Пользователей с картами:* {stats['users_with_cards']}
+        💎 Пользователей с премиумом: {stats['premium_users']}
+        🚀 Конверсия в премиум: {stats['premium_conversion']:.2f}%
+        💎 Активных премиум-подписок: {stats['active_premium_users']}
         
-        📦 *Всего карт:* {total_cards}
-        📈 *Среднее количество карт на пользователя:* {avg_cards_per_user:.2f}
-        📅 *Retention rate (за последние 7 дней):* {retention_rate:.2f}%
+        📦 *Всего карт:* {stats['total_cards']}
+        📈 *Среднее количество карт на пользователя:* {stats['avg_cards_per_user']:.2f}
+        📅 *Retention rate (за последние 7 дней):* {stats['retention_rate']:.2f}%
 
-        🚀 *Активные пользователи (за последние 7 дней):* {active_users_last_7_days}
-        🆕 *Новые пользователи (за последние 7 дней):* {new_users_last_7_days}
-        🔄 *Конверсия в загрузку карт:* {conversion_rate:.2f}%
-        ⏳ *Среднее время между первым и последним использованием:* {avg_usage_duration:.2f} дней
+        🚀 *Активные пользователи (за последние 7 дней):* {stats['active_users_last_7_days']}
+        🆕 *Новые пользователи (за последние 7 дней):* {stats['new_users_last_7_days']}
+        🔄 *Конверсия в загрузку карт:* {stats['conversion_rate']:.2f}%
+        ⏳ *Среднее время между первым и последним использованием:* {stats['avg_usage_duration']:.2f} дней
 
         🏆 *Топ-5 популярных карт:*
     """).strip()
 
-    for i, (name, count) in enumerate(top_cards, start=1):
+    for i, (name, count) in enumerate(stats['top_cards'], start=1):
         stats_text += f"\n  {i}. {name} (выбрана {count} раз)"
 
     stats_text += textwrap.dedent(f"""
-        📅 *Карт загружено за последние 7 дней:* {cards_last_7_days}
-        📦 *Среднее количество карт на активного пользователя:* {avg_cards_per_active_user:.2f}
+        📅 *Карт загружено за последние 7 дней:* {stats['cards_last_7_days']}
+        📦 *Среднее количество карт на активного пользователя:* {stats['avg_cards_per_active_user']:.2f}
+        💾 *Хранилище фото:* {stats['storage_used'] / 1024 / 1024:.2f} МБ, сэкономлено на дубликатах {stats['storage_saved'] / 1024 / 1024:.2f} МБ
     """).strip()
 
-    await update.message.reply_text(stats_text, parse_mode="Markdown")
+    cache = {**repository.cache_stats(), 'pages': page_cache.stats()}
+    stats_text += "\n\n🗄 *Кэш:*"
+    for name, counters in cache.items():
+        stats_text += (
+            f"\n  {name}: {counters['hits']} попаданий, {counters['misses']} промахов "
+            f"({counters['hit_rate']:.2f}%), записей: {counters['size']}"
+        )
 
-    conn.close()
+    await update.message.reply_text(stats_text, parse_mode="Markdown")
 
 async def handle_card_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
     user_id = query.from_user.id
-    if not can_view_more_cards(user_id):
+    if not (await get_access_context(user_id)).can_view:
         await query.edit_message_text(
             f"❌ Вы достигли лимита просмотров карт на этот месяц.\n"
             "Для неограниченного доступа к картам используйте команду /buy"
@@ -468,26 +400,136 @@ async def handle_card_selection(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
     card_id = int(query.data.split("_")[1])
-    increment_user_views(user_id)
-
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR IGNORE INTO card_stats (card_id) VALUES (?)
-    ''', (card_id,))
-    cursor.execute('''
-        UPDATE card_stats SET selection_count = selection_count + 1 WHERE card_id = ?
-    ''', (card_id,))
-    conn.commit()
-
-    cursor.execute('SELECT photo FROM cards WHERE id = ?', (card_id,))
-    card = cursor.fetchone()
-    conn.close()
+    await increment_user_views(user_id)
+
+    card = await select_card(card_id, user_id)
 
     if not card:
         await query.edit_message_text("❌ Карта не найдена.")
+        return
+
+    name, photo_path, file_id, barcode, barcode_format = card
+    if barcode:
+        # A decoded number is a few bytes of text instead of a photo; the
+        # photo stays one tap away.
+        await query.message.reply_text(
+            f"💳 <b>{html.escape(name)}</b>\n\n"
+            f"Номер карты ({barcode_format}): <code>{html.escape(barcode)}</code>",
+            parse_mode="HTML",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("📷 Показать фото", callback_data=f"photo_{card_id}")
+            ]]),
+        )
     else:
-        await query.message.reply_photo(open(card[0], 'rb'))
+        await send_card_photo(query.message, card_id, photo_path, file_id)
+
+async def handle_card_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # The photo of a card whose number was just shown: that selection already
+    # counted as the view, and the number message is left as it is.
+    query = update.callback_query
+    card_id = int(query.data.split("_")[1])
+    card = await repository.get_card(card_id)
+    if not card:
+        await query.message.reply_text("❌ Карта не найдена.")
+        return
+
+    _, photo_path, file_id, _, _ = card
+    await send_card_photo(query.message, card_id, photo_path, file_id)
+
+async def send_card_photo(message: Message, card_id: int, photo_path: str, file_id: str = None):
+    # Telegram keeps every photo it has seen, so a cached file_id is re-sent by
+    # reference. The file is uploaded again only when the id is missing or stale.
+    if file_id:
+        try:
+            return await message.reply_photo(file_id)
+        except BadRequest:
+            await repository.set_card_file_id(card_id, None)
+
+    sent = await message.reply_photo(await storage.read_photo(photo_path))
+    await repository.set_card_file_id(card_id, sent.photo[-1].file_id)
+    return sent
+
+async def backfill_file_ids(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        await update.message.reply_text("❌ Используйте команду так: /backfill_file_ids <пароль>")
+        return
+
+    password = context.args[0]
+    admin_password = environ.get("ADMIN_PASSWORD")
+
+    if password != admin_password:
+        await update.message.reply_text("❌ Неверный пароль.")
+        return
+
+    uploaded = 0
+    missing = 0
+    last_id = 0
+    while True:
+        cards = await repository.get_cards_without_file_id(after=last_id)
+        if not cards:
+            break
+
+        for card_id, photo_path in cards:
+            last_id = card_id
+            if not photo_path or not await storage.photo_exists(photo_path):
+                missing += 1
+                continue
+
+            sent = await send_card_photo(update.message, card_id, photo_path)
+            await sent.delete()
+            uploaded += 1
+            await asyncio.sleep(1)
+
+    await update.message.reply_text(f"✅ Загружено карт: {uploaded}. Файлы не найдены: {missing}.")
+
+async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        await update.message.reply_text("❌ Используйте команду так: /export <пароль>")
+        return
+
+    password = context.args[0]
+    admin_password = environ.get("ADMIN_PASSWORD")
+
+    if password != admin_password:
+        await update.message.reply_text("❌ Неверный пароль.")
+        return
+
+    with tempfile.TemporaryFile() as archive:
+        exported, photos, missing = await backup.export_archive(archive)
+        archive.seek(0)
+        await update.message.reply_document(
+            archive,
+            filename=f"discount_cards_{datetime.now():%Y%m%d_%H%M%S}.tar.gz",
+            caption=f"📦 Карт: {exported['cards']}, пользователей: {exported['users']}, "
+                    f"фото: {photos}, не найдено: {missing}.",
+            write_timeout=300,
+        )
+
+async def import_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # The archive comes as a document captioned "/import <пароль>".
+    args = update.message.caption.split()[1:]
+    if not args:
+        await update.message.reply_text("❌ Отправьте архив с подписью /import <пароль>")
+        return
+
+    password = args[0]
+    admin_password = environ.get("ADMIN_PASSWORD")
+
+    if password != admin_password:
+        await update.message.reply_text("❌ Неверный пароль.")
+        return
+
+    document_file = await update.message.document.get_file()
+    with tempfile.TemporaryFile() as archive:
+        async for chunk in storage.download(document_file.file_path):
+            archive.write(chunk)
+        archive.seek(0)
+        imported, photos = await backup.import_archive(archive)
+
+    await update.message.reply_text(
+        f"✅ Загружено карт: {imported['cards']}, пользователей: {imported['users']}, "
+        f"премиум: {imported['premium_users']}, фото: {photos}."
+    )
 
 async def load_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
@@ -506,53 +548,6 @@ async def load_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(load_instructions, parse_mode="Markdown")
 
-def get_current_month_year():
-    return datetime.now().strftime("%Y-%m")
-
-def get_user_monthly_views(user_id):
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    current_month = get_current_month_year()
-    
-    cursor.execute('''
-        SELECT views_count FROM card_views 
-        WHERE user_id = ? AND month_year = ?
-    ''', (user_id, current_month))
-    result = cursor.fetchone()
-    
-    if result is None:
-        cursor.execute('''
-            INSERT INTO card_views (user_id, month_year, views_count)
-            VALUES (?, ?, 0)
-        ''', (user_id, current_month))
-        conn.commit()
-        views = 0
-    else:
-        views = result[0]
-    
-    conn.close()
-    return views
-
-def increment_user_views(user_id):
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    current_month = get_current_month_year()
-    
-    cursor.execute('''
-        INSERT INTO card_views (user_id, month_year, views_count)
-        VALUES (?, ?, 1)
-        ON CONFLICT(user_id, month_year) 
-        DO UPDATE SET views_count = views_count + 1
-    ''', (user_id, current_month))
-    
-    conn.commit()
-    conn.close()
-
-def can_view_more_cards(user_id):
-    if has_premium_access(user_id):
-        return True
-    return get_user_monthly_views(user_id) < 5
-
 async def revoke_premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or len(context.args) < 2:
         await update.message.reply_text("❌ Используйте команду так: /revoke_premium <user_id> <пароль>")
@@ -566,24 +561,64 @@ async def revoke_premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Неверный пароль.")
         return
 
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM premium_users WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    await repository.revoke_premium(user_id)
 
     await update.message.reply_text(f"✅ Премиум-доступ для пользователя {user_id} успешно отозван.")
 
-def main():
-    bot_token = environ.get("BOT_TOKEN")
-    if not bot_token:
-        raise ValueError("Необходимо указать BOT_TOKEN в переменных окружения.")
+@metrics.register_collector
+def collect_runtime_metrics():
+    caches = {**repository.cache_stats(), 'pages': page_cache.stats()}
+    return [
+        ('bot_cache_hits_total', 'counter', 'Cache lookups that found an entry.',
+         [({'cache': name}, counters['hits']) for name, counters in caches.items()]),
+        ('bot_cache_misses_total', 'counter', 'Cache lookups that missed.',
+         [({'cache': name}, counters['misses']) for name, counters in caches.items()]),
+        ('bot_cache_entries', 'gauge', 'Entries held by each cache.',
+         [({'cache': name}, counters['size']) for name, counters in caches.items()]),
+        ('bot_db_statements_total', 'counter', 'Database statements executed.', [({}, db.statement_count())]),
+        ('bot_db_commits_total', 'counter', 'Database transactions committed.', [({}, db.commit_count())]),
+        ('bot_write_buffer_flushes_total', 'counter', 'Write-behind buffer flushes.',
+         [({}, repository.write_buffer.flushes)]),
+    ]
 
-    application = Application.builder().token(bot_token).build()
+metrics_server = metrics.MetricsServer(
+    environ.get("METRICS_HOST", "127.0.0.1"),
+    int(environ.get("METRICS_PORT", "9100")),
+)
+
+async def startup(application: Application):
+    repository.write_buffer.start()
+    await repository.load_ranking()
+    if metrics_server.port:
+        await metrics_server.start()
+
+async def shutdown(application: Application):
+    await metrics_server.stop()
+    await repository.write_buffer.stop()
+    await storage.close()
+    images.close()
+    db.close()
+
+def build_application(bot_token: str) -> Application:
+    builder = Application.builder().token(bot_token).post_init(startup).post_shutdown(shutdown)
+    builder.persistence(SQLitePersistence())
+    builder.request(metrics.InstrumentedRequest(connection_pool_size=256))
+    builder.get_updates_request(metrics.InstrumentedRequest())
+    outbound_limiter = ratelimit.outbound_from_env()
+    if outbound_limiter:
+        builder.rate_limiter(outbound_limiter)
+
+    # A self-hosted Bot API server (or a local stand-in) can replace api.telegram.org.
+    api_url = environ.get("TELEGRAM_API_URL")
+    if api_url:
+        builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot")
+
+    application = builder.build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("info", info))
-    application.add_handler(CommandHandler("list", lambda u, c: list_cards(u.message, c, page=0)))
+    application.add_handler(CommandHandler("list", list_command))
+    application.add_handler(CommandHandler("find", find_cards))
     application.add_handler(CommandHandler("load", load_command))
     application.add_handler(CommandHandler("buy", start_payment))
     application.add_handler(CommandHandler("stats", stats))
@@ -591,6 +626,9 @@ def main():
     application.add_handler(CommandHandler("grant_premium", grant_premium))
     application.add_handler(CommandHandler("revoke_premium", revoke_premium))
     application.add_handler(CommandHandler("delete", delete_card))
+    application.add_handler(CommandHandler("backfill_file_ids", backfill_file_ids))
+    application.add_handler(CommandHandler("export", export_data))
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import\b"), import_data))
 
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_name))
@@ -599,8 +637,43 @@ def main():
     application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment))
 
     application.add_handler(CallbackQueryHandler(handle_list_pagination))
+    application.add_handler(InlineQueryHandler(inline_search))
+
+    metrics.instrument_handlers(application)
+    maintenance.schedule(application)
+
+    # Updates are still dispatched one by one, but callbacks run as separate
+    # tasks: different users in parallel, each user's updates in order.
+    serialize_handlers(application, int(environ.get("CONCURRENT_UPDATES", "64")))
+
+    # Added last so it stays blocking: a throttled update is dropped before
+    # it reaches any handler or the database.
+    inbound_limiter = ratelimit.inbound_from_env()
+    if inbound_limiter:
+        inbound_limiter.install(application)
 
-    application.run_polling()
+    return application
+
+def main():
+    bot_token = environ.get("BOT_TOKEN")
+    if not bot_token:
+        raise ValueError("Необходимо указать BOT_TOKEN в переменных окружения.")
+
+    # Pending schema migrations run once here, before any update is handled.
+    create_database()
+    application = build_application(bot_token)
+
+    if environ.get("BOT_MODE", "polling") == "webhook":
+        application.run_webhook(
+            listen=environ.get("WEBHOOK_LISTEN", "0.0.0.0"),
+            port=int(environ.get("WEBHOOK_PORT", "8443")),
+            url_path=environ.get("WEBHOOK_PATH", "telegram"),
+            webhook_url=environ.get("WEBHOOK_URL"),
+            secret_token=environ.get("WEBHOOK_SECRET"),
+            max_connections=int(environ.get("WEBHOOK_MAX_CONNECTIONS", "40")),
+        )
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
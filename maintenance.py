@@ -0,0 +1,131 @@
+import logging
+import time
+from datetime import datetime
+
+from telegram.error import Forbidden, TelegramError
+
+import db
+import metrics
+import repository
+import storage
+
+logger = logging.getLogger(__name__)
+
+EXPIRY_INTERVAL = 600
+EXPIRY_BATCH_SIZE = 100
+UPLOAD_CLEANUP_INTERVAL = 600
+VIEWS_ARCHIVE_INTERVAL = 24 * 3600
+VIEWS_KEEP_MONTHS = 2
+COMPACT_INTERVAL = 24 * 3600
+VACUUM_PAGES = 2000
+RANKING_REFRESH_INTERVAL = 600
+
+job_duration = metrics.Histogram(
+    'bot_job_duration_seconds', 'Time spent in maintenance jobs.', ('job',))
+job_errors = metrics.Counter(
+    'bot_job_errors_total', 'Maintenance job runs that failed.', ('job',))
+metrics.METRICS.extend([job_duration, job_errors])
+
+
+def timed(name, job):
+    async def run(context):
+        token = metrics.current_handler.set(name)
+        started = time.perf_counter()
+        try:
+            result = await job(context)
+        except Exception:
+            job_errors.inc(name)
+            logger.exception("Задача %s завершилась с ошибкой", name)
+        else:
+            logger.info("Задача %s: %s за %.2f с", name, result, time.perf_counter() - started)
+        finally:
+            job_duration.observe(time.perf_counter() - started, name)
+            metrics.current_handler.reset(token)
+
+    return run
+
+
+async def expire_premium(context):
+    # Access itself lapses on its own: premium_until is compared with the
+    # clock on every check. This only tells each user once that it has
+    # lapsed, claiming them in batches so replicas never notify twice.
+    notified = 0
+    while user_ids := await repository.claim_expired_premium(EXPIRY_BATCH_SIZE):
+        for user_id in user_ids:
+            try:
+                await context.bot.send_message(
+                    user_id,
+                    "⏳ Ваш премиум-доступ закончился. Чтобы продлить его, используйте команду /buy."
+                )
+            except Forbidden:
+                pass
+            except TelegramError:
+                logger.warning("Не удалось уведомить пользователя %s об окончании премиума", user_id)
+        notified += len(user_ids)
+        if len(user_ids) < EXPIRY_BATCH_SIZE:
+            break
+    return f"уведомлено {notified}"
+
+
+async def cleanup_uploads(context):
+    # Pending uploads that never got a name are dropped after
+    # PENDING_UPLOAD_TTL; their photos, and any other blob no card refers
+    # to, are then removed from storage.
+    expired = await repository.delete_expired_uploads()
+    deleted = await repository.delete_orphan_blobs()
+    for path in deleted:
+        await storage.delete_photo(path)
+    return f"загрузок {expired}, файлов {len(deleted)}"
+
+
+async def archive_views(context):
+    # Only the current month's views matter for the quota; older months are
+    # folded into one row per month.
+    now = datetime.now()
+    month_index = now.year * 12 + now.month - 1 - (VIEWS_KEEP_MONTHS - 1)
+    keep_from = f"{month_index // 12:04d}-{month_index % 12 + 1:02d}"
+    archived = await repository.archive_card_views(keep_from)
+    return f"месяцев {archived}"
+
+
+async def refresh_ranking(context):
+    # Selections move the in-memory ranking as they happen; reloading it from
+    # the flushed scores brings in those made on other replicas.
+    await repository.write_buffer.flush()
+    await repository.load_ranking()
+    return f"карт {len(repository.popularity)}"
+
+
+def _compact(cursor):
+    if db.DIALECT == 'postgres':
+        # Autovacuum reclaims space on PostgreSQL; only the statistics are
+        # refreshed here.
+        cursor.execute('ANALYZE')
+        return 0
+    cursor.execute('PRAGMA auto_vacuum')
+    if cursor.fetchone()[0] != 2:
+        # Databases created before incremental auto-vacuum need one full
+        # VACUUM for the setting to take effect.
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+    cursor.execute('PRAGMA freelist_count')
+    free_pages = cursor.fetchone()[0]
+    cursor.execute(f'PRAGMA incremental_vacuum({VACUUM_PAGES})').fetchall()
+    cursor.execute('PRAGMA optimize')
+    return free_pages
+
+
+async def compact(context):
+    free_pages = await db.run(_compact)
+    return f"свободных страниц было {free_pages}"
+
+
+def schedule(application):
+    for name, job, interval, first in (
+        ('expire_premium', expire_premium, EXPIRY_INTERVAL, 60),
+        ('cleanup_uploads', cleanup_uploads, UPLOAD_CLEANUP_INTERVAL, UPLOAD_CLEANUP_INTERVAL),
+        ('archive_views', archive_views, VIEWS_ARCHIVE_INTERVAL, 300),
+        ('compact', compact, COMPACT_INTERVAL, 600),
+        ('refresh_ranking', refresh_ranking, RANKING_REFRESH_INTERVAL, RANKING_REFRESH_INTERVAL),
+    ):
+        application.job_queue.run_repeating(timed(name, job), interval, first=first, name=name)
@@ -0,0 +1,221 @@
+import asyncio
+import bisect
+import functools
+import logging
+import time
+from contextvars import ContextVar
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Name of the handler whose task is running. Queries issued outside a handler,
+# such as write-behind flushes, are attributed to "background".
+current_handler = ContextVar('current_handler', default='background')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = (f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Per label set: a count per bucket (the last one is +Inf), sum, count.
+        self._series = {}
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                bucket_labels = _format_labels(self.labels + ('le',), labels + (le,))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {count}")
+        return lines
+
+
+handler_duration = Histogram(
+    'bot_handler_duration_seconds', 'Time spent in update handlers.', ('handler',))
+handler_errors = Counter(
+    'bot_handler_errors_total', 'Exceptions raised by update handlers.', ('handler',))
+db_queries = Counter(
+    'bot_db_queries_total', 'Database statements executed, by the handler that issued them.', ('handler',))
+db_duration = Histogram(
+    'bot_db_call_duration_seconds', 'Database calls including the wait for the database thread.', ('handler',))
+telegram_duration = Histogram(
+    'bot_telegram_api_duration_seconds', 'Bot API request latency.', ('method',))
+telegram_errors = Counter(
+    'bot_telegram_api_errors_total', 'Bot API requests that failed to complete.', ('method',))
+
+METRICS = [handler_duration, handler_errors, db_queries, db_duration, telegram_duration, telegram_errors]
+
+# Callables returning extra (name, type, documentation, [(labels dict, value)])
+# families, read at scrape time for state that is already counted elsewhere.
+_collectors = []
+
+
+def register_collector(collect):
+    _collectors.append(collect)
+    return collect
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        for name, kind, documentation, samples in collect():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+def record_db_call(statements, duration):
+    handler = current_handler.get()
+    db_queries.inc(handler, amount=statements)
+    db_duration.observe(duration, handler)
+
+
+def instrument(callback, name=None):
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def instrumented(update, context):
+        token = current_handler.set(name)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_duration.observe(time.perf_counter() - started, name)
+            current_handler.reset(token)
+
+    return instrumented
+
+
+def instrument_handlers(application):
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument(handler.callback)
+
+
+def _api_method(url):
+    # Files are fetched from /file/bot<token>/<path>; the path is not a
+    # useful label, and neither is the token in front of either URL.
+    if '/file/bot' in url:
+        return 'file'
+    return url.rsplit('/', 1)[-1]
+
+
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = _api_method(url)
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception:
+            telegram_errors.inc(api_method)
+            raise
+        finally:
+            telegram_duration.observe(time.perf_counter() - started, api_method)
+
+
+class MetricsServer:
+    # A bare asyncio HTTP server answering GET /metrics with the current
+    # metrics in the Prometheus text exposition format.
+    def __init__(self, host='127.0.0.1', port=9100):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Metrics available on http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+
+            path = request_line.split()[1] if len(request_line.split()) > 1 else b'/'
+            if path.split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', render().encode()
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,86 @@
+import json
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import repository
+
+
+class SQLitePersistence(BasePersistence):
+    # user_data and chat_data live as JSON rows in conversation_data. PTB hands
+    # over whatever changed every `update_interval` seconds; unchanged data is
+    # skipped and the rest goes through the write-behind buffer, so it is
+    # committed in the same batch as the other buffered writes.
+    #
+    # Each process loads its copy once at startup and never reloads it, so
+    # with several replicas user_data is not shared between them. Anything a
+    # later update may need on another replica, like a pending upload, goes
+    # in a table of its own.
+    def __init__(self, update_interval=5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._stored = {'user_data': {}, 'chat_data': {}}
+
+    async def _load(self, kind):
+        rows = await repository.load_conversation_data(kind)
+        self._stored[kind] = rows
+        return {key: json.loads(data) for key, data in rows.items()}
+
+    def _update(self, kind, key, data):
+        data = json.dumps(data, ensure_ascii=False, sort_keys=True) if data else None
+        if self._stored[kind].get(key) == data:
+            return
+        if data is None:
+            self._stored[kind].pop(key, None)
+        else:
+            self._stored[kind][key] = data
+        repository.write_buffer.put(kind, key, data)
+
+    async def get_user_data(self):
+        return await self._load('user_data')
+
+    async def get_chat_data(self):
+        return await self._load('chat_data')
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_user_data(self, user_id, data):
+        self._update('user_data', user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._update('chat_data', chat_id, data)
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._update('user_data', user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self._update('chat_data', chat_id, None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        await repository.write_buffer.flush()
@@ -0,0 +1,295 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+
+try:
+    from psycopg_pool import ConnectionPool
+except ImportError:
+    ConnectionPool = None
+
+import db
+import ranking
+
+POOL_SIZE = int(environ.get("DATABASE_POOL_SIZE", 10))
+MIGRATION_LOCK = 0x636172647321
+
+_trigram = None
+
+# Question marks outside string literals are parameters.
+_PLACEHOLDER = re.compile(r"'[^']*'|\?")
+
+
+def _translate(sql):
+    # The repository writes sqlite3's `?` placeholders; psycopg wants `%s`,
+    # and a literal `%` has to be doubled.
+    sql = sql.replace('%', '%%')
+    return _PLACEHOLDER.sub(lambda match: '%s' if match.group() == '?' else match.group(), sql)
+
+
+class Cursor:
+    # Just enough of sqlite3.Cursor for the repository's cursor functions:
+    # execute() returns the cursor, and rows come back as tuples. Statements
+    # are counted per cursor, which is per call.
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.statements = 0
+
+    @property
+    def connection(self):
+        return self._cursor.connection
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def execute(self, sql, params=()):
+        self.statements += 1
+        self._cursor.execute(_translate(sql), params)
+        return self
+
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        if rows:
+            self.statements += 1
+            self._cursor.executemany(_translate(sql), rows)
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size):
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+class PostgresBackend:
+    # Unlike SQLite, PostgreSQL takes concurrent writers, so there is one
+    # executor thread per pooled connection. Every call is its own
+    # transaction, committed when the function returns.
+    dialect = 'postgres'
+
+    def __init__(self, url, pool_size=POOL_SIZE):
+        if ConnectionPool is None:
+            raise RuntimeError("DATABASE_URL requires psycopg: pip install 'psycopg[binary]' psycopg_pool")
+        # Timestamps are stored without a zone and compared with
+        # CURRENT_TIMESTAMP, which must be UTC as it is in SQLite.
+        self.pool = ConnectionPool(url, min_size=1, max_size=pool_size, kwargs={"options": "-c timezone=UTC"})
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="db")
+
+    def call(self, func, args):
+        # Returns the result and the number of statements it took.
+        cursor = None
+        committed = False
+        try:
+            with self.pool.connection() as conn:
+                cursor = Cursor(conn.cursor())
+                result = func(cursor, *args)
+            committed = True
+        finally:
+            db._record_call(cursor.statements if cursor else 0, committed)
+        return result, cursor.statements
+
+    def close(self):
+        self.pool.close()
+
+
+def _create_schema(cursor):
+    # The SQLite schema as of its third migration, in one step. There are no
+    # FTS triggers: catalog search uses a pg_trgm index instead.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            first_use TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_use TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cards (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            user_id BIGINT,
+            name TEXT,
+            photo TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            file_id TEXT,
+            barcode TEXT,
+            barcode_format TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS card_stats (
+            card_id BIGINT PRIMARY KEY REFERENCES cards (id) ON DELETE CASCADE,
+            selection_count INTEGER DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS premium_users (
+            user_id BIGINT PRIMARY KEY,
+            premium_until TIMESTAMP,
+            expiry_notified INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    db.mark_lapsed_premium_notified(cursor)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS card_views (
+            user_id BIGINT,
+            month_year TEXT,
+            views_count INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, month_year)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS card_views_archive (
+            month_year TEXT PRIMARY KEY,
+            users BIGINT NOT NULL,
+            views BIGINT NOT NULL
+        )
+    ''')
+    # Byte order, like SQLite's BINARY collation, so the prefix range in
+    # search_cards means the same thing on both backends.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS card_catalog (
+            name_key TEXT COLLATE "C" PRIMARY KEY,
+            card_id BIGINT NOT NULL UNIQUE,
+            name TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            size BIGINT NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_data (
+            kind TEXT NOT NULL,
+            id BIGINT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value DOUBLE PRECISION NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT PRIMARY KEY,
+            new_users INTEGER NOT NULL DEFAULT 0,
+            new_cards INTEGER NOT NULL DEFAULT 0,
+            last_seen_users INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_card_counts (
+            user_id BIGINT PRIMARY KEY,
+            cards INTEGER NOT NULL
+        )
+    ''')
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cards_barcode ON cards (barcode)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cards_user_id ON cards (user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cards_created_day ON cards ((CAST(created_at AS DATE)))')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cards_lower_name ON cards (LOWER(name))')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_first_use_day ON users ((CAST(first_use AS DATE)))')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_card_views_month ON card_views (month_year)')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_premium_users_expiry ON premium_users (premium_until, expiry_notified)
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_card_stats_selection_count ON card_stats (selection_count)')
+
+    # pg_trgm ships with PostgreSQL's contrib package, which not every server
+    # has; without it search_cards falls back to LIKE over the query's
+    # trigrams. A server that gets it later needs _create_trigram_index run
+    # once by hand.
+    cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+    if cursor.fetchone():
+        _create_trigram_index(cursor)
+
+
+def _create_trigram_index(cursor):
+    cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_card_catalog_search
+        ON card_catalog USING GIN ((REPLACE(name_key, 'ё', 'е')) gin_trgm_ops)
+    ''')
+
+
+def has_trigram(cursor):
+    global _trigram
+    if _trigram is None:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        _trigram = cursor.fetchone() is not None
+    return _trigram
+
+
+def _card_popularity(cursor):
+    cursor.execute('ALTER TABLE card_stats ADD COLUMN IF NOT EXISTS popularity DOUBLE PRECISION NOT NULL DEFAULT 0')
+    cursor.execute('UPDATE card_stats SET popularity = selection_count * ?', (ranking.weight(),))
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_card_selections (
+            user_id BIGINT NOT NULL,
+            card_id BIGINT NOT NULL REFERENCES cards (id) ON DELETE CASCADE,
+            score DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, card_id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_card_selections_card_id ON user_card_selections (card_id)')
+
+
+def _card_name_keys(cursor):
+    cursor.execute('ALTER TABLE cards ADD COLUMN IF NOT EXISTS name_key TEXT')
+    db.fill_name_keys(cursor)
+    cursor.execute('DROP INDEX IF EXISTS idx_cards_lower_name')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cards_name_key ON cards (name_key)')
+
+
+def _pending_uploads(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_uploads (
+            user_id BIGINT PRIMARY KEY,
+            photo TEXT NOT NULL,
+            file_id TEXT,
+            barcode TEXT,
+            barcode_format TEXT,
+            uploaded_at DOUBLE PRECISION NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pending_uploads_uploaded_at ON pending_uploads (uploaded_at)')
+    db.move_pending_uploads(cursor)
+
+
+def _card_search_prefix(cursor):
+    # REPLACE keeps name_key's "C" collation, so the index orders keys the
+    # way the byte-wise prefix range in repository._search_cards compares.
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_card_catalog_search_prefix
+        ON card_catalog ((REPLACE(name_key, 'ё', 'е')))
+    ''')
+
+
+# Versions line up with db.MIGRATIONS: a step added there for SQLite gets its
+# PostgreSQL counterpart here under the same number.
+MIGRATIONS = (
+    (1, "baseline schema", _create_schema),
+    (2, "query indexes", lambda cursor: None),
+    (3, "card_stats cascades from cards", lambda cursor: None),
+    (4, "decayed card popularity", _card_popularity),
+    (5, "cards.name_key", _card_name_keys),
+    (6, "pending uploads table", _pending_uploads),
+    (7, "folded card name prefix index", _card_search_prefix),
+)
@@ -0,0 +1,114 @@
+import bisect
+import time
+from collections import OrderedDict
+
+HALF_LIFE = 14 * 86400
+# Scores are kept relative to a fixed moment: a selection at time t adds
+# 2 ** ((t - EPOCH) / HALF_LIFE). All scores decay at the same rate, so the
+# order only changes when a card is selected and stored scores never need
+# rewriting. A double overflows about 39 years after EPOCH at this half-life.
+EPOCH = 1767225600  # 2026-01-01 00:00 UTC
+# Orders kept for pages turned after the ranking moved on.
+SNAPSHOTS = 16
+
+
+def weight(timestamp=None):
+    # What one selection made at `timestamp`, now by default, adds to a score.
+    if timestamp is None:
+        timestamp = time.time()
+    return 2 ** ((timestamp - EPOCH) / HALF_LIFE)
+
+
+def decayed(score, timestamp=None):
+    # A stored score as the number of selections it is worth at `timestamp`.
+    return score / weight(timestamp)
+
+
+class Ranking:
+    # Catalog cards ordered by popularity, most popular first and ties by id,
+    # kept as a sorted list of (-score, card_id). A selection moves one card
+    # to its new place with two binary searches instead of re-sorting.
+    #
+    # Pages are cut from numbered snapshots of that order, so a /list that is
+    # paged through while selections reorder the ranking neither repeats nor
+    # skips cards. A snapshot is copied only when a first page is asked for
+    # and the order changed since the last one.
+    def __init__(self):
+        self.version = 0
+        self.loaded = False
+        self._scores = {}
+        self._names = {}
+        self._order = []
+        self._changed = True
+        self._snapshots = OrderedDict()
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, card_id):
+        return card_id in self._scores
+
+    def load(self, rows):
+        # rows: (card_id, name, score) for every card in the catalog.
+        self._scores = {}
+        self._names = {}
+        for card_id, name, score in rows:
+            self._scores[card_id] = score
+            self._names[card_id] = name
+        # Already sorted rows make this a linear pass.
+        self._order = sorted((-score, card_id) for card_id, score in self._scores.items())
+        self.loaded = True
+        self._changed = True
+
+    def clear(self):
+        self.load(())
+        self.loaded = False
+
+    def add(self, card_id, name, score=0.0):
+        self.remove(card_id)
+        self._scores[card_id] = score
+        self._names[card_id] = name
+        bisect.insort(self._order, (-score, card_id))
+        self._changed = True
+
+    def remove(self, card_id):
+        score = self._scores.pop(card_id, None)
+        if score is None:
+            return
+        del self._names[card_id]
+        del self._order[bisect.bisect_left(self._order, (-score, card_id))]
+        self._changed = True
+
+    def record(self, card_id, delta):
+        score = self._scores.get(card_id)
+        if score is None:
+            return
+        index = bisect.bisect_left(self._order, (-score, card_id))
+        del self._order[index]
+        score += delta
+        self._scores[card_id] = score
+        new_index = bisect.bisect_left(self._order, (-score, card_id))
+        self._order.insert(new_index, (-score, card_id))
+        if new_index != index:
+            self._changed = True
+
+    def name(self, card_id):
+        return self._names.get(card_id)
+
+    def snapshot(self, version=None):
+        # The snapshot a page is cut from: `version` while it is still kept,
+        # otherwise the current order.
+        if version in self._snapshots:
+            return version
+        if self._changed:
+            self.version += 1
+            self._snapshots[self.version] = list(self._order)
+            if len(self._snapshots) > SNAPSHOTS:
+                self._snapshots.popitem(last=False)
+            self._changed = False
+        return self.version
+
+    def page(self, page, page_size, version):
+        # Cards deleted since the snapshot was taken are left out.
+        order = self._snapshots[version][page * page_size:(page + 1) * page_size]
+        return [(card_id, self._names[card_id]) for _, card_id in order if card_id in self._names]
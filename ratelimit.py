@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import time
+from os import environ
+
+from telegram import Update
+from telegram.error import RetryAfter
+from telegram.ext import ApplicationHandlerStop, BaseRateLimiter, TypeHandler
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Buckets that have refilled are dropped once this many are tracked, so idle
+# users and chats do not accumulate.
+MAX_IDLE_BUCKETS = 10000
+NOTICE_INTERVAL = 30
+THROTTLED_MESSAGE = "⏳ Слишком много запросов, подождите немного."
+
+inbound_dropped = metrics.Counter(
+    'bot_inbound_throttled_total', 'Updates dropped by the inbound limiter.', ('scope',))
+outbound_wait = metrics.Histogram(
+    'bot_outbound_wait_seconds', 'Time Bot API requests waited for the outbound limiter.', ('scope',))
+outbound_retry_after = metrics.Counter(
+    'bot_outbound_retry_after_total', 'Bot API requests answered with 429 Too Many Requests.', ('method',))
+metrics.METRICS.extend([inbound_dropped, outbound_wait, outbound_retry_after])
+
+
+class TokenBucket:
+    # `rate` tokens per second, at most `capacity` saved up. Tokens may go
+    # negative: reserve() hands out the next free slot and returns how long to
+    # wait for it, so waiters are served in the order they arrived.
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        self._refill(time.monotonic())
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def reserve(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+        return max(-self.tokens / self.rate, 0.0)
+
+    def is_full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+def _prune(buckets):
+    if len(buckets) > MAX_IDLE_BUCKETS:
+        for key in [key for key, bucket in buckets.items() if bucket.is_full()]:
+            del buckets[key]
+
+
+class InboundLimiter:
+    # Every update spends a token from its user's bucket and from its chat's
+    # bucket; when either is empty the update is dropped before any handler
+    # runs. The user is told about it at most once every NOTICE_INTERVAL
+    # seconds, not once per dropped update.
+    def __init__(self, user_rate, user_burst, chat_rate, chat_burst):
+        self.limits = {'user': (user_rate, user_burst), 'chat': (chat_rate, chat_burst)}
+        self._buckets = {'user': {}, 'chat': {}}
+        self._noticed = {}
+
+    def _acquire(self, scope, key):
+        buckets = self._buckets[scope]
+        bucket = buckets.get(key)
+        if bucket is None:
+            _prune(buckets)
+            bucket = buckets[key] = TokenBucket(*self.limits[scope])
+        return bucket.try_acquire()
+
+    def check(self, update):
+        # The scope that ran out, or None when the update may proceed. Payment
+        # updates always pass: Telegram waits only seconds for the answer.
+        if update.pre_checkout_query or (update.message and update.message.successful_payment):
+            return None
+        for scope, entity in (('user', update.effective_user), ('chat', update.effective_chat)):
+            if entity is not None and not self._acquire(scope, entity.id):
+                return scope
+        return None
+
+    async def __call__(self, update, context):
+        scope = self.check(update)
+        if scope is None:
+            return
+
+        inbound_dropped.inc(scope)
+        # The notice goes out as its own task: this handler blocks dispatching,
+        # and the reply itself may wait for the outbound limiter.
+        if update.callback_query:
+            # Always answered, otherwise the button keeps spinning.
+            context.application.create_task(update.callback_query.answer(THROTTLED_MESSAGE))
+        elif update.effective_message and self._should_notice(update.effective_message.chat_id):
+            context.application.create_task(update.effective_message.reply_text(THROTTLED_MESSAGE))
+        raise ApplicationHandlerStop
+
+    def _should_notice(self, chat_id):
+        now = time.monotonic()
+        if now - self._noticed.get(chat_id, -NOTICE_INTERVAL) < NOTICE_INTERVAL:
+            return False
+        if len(self._noticed) > MAX_IDLE_BUCKETS:
+            self._noticed = {key: at for key, at in self._noticed.items() if now - at < NOTICE_INTERVAL}
+        self._noticed[chat_id] = now
+        return True
+
+    def install(self, application, group=-2):
+        # Blocking and in its own group, so ApplicationHandlerStop keeps the
+        # update away from every later group.
+        application.add_handler(TypeHandler(Update, self), group=group)
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    # Requests addressed to a chat wait for a slot in that chat's bucket (one
+    # message per second in private chats, 20 per minute in groups) and then
+    # in the bot-wide bucket of 30 messages per second, which is kept nearly
+    # empty so the 30 are spread over the second. A 429 pauses every
+    # request for retry_after seconds before the failed one is retried.
+    def __init__(self, overall_rate=30, overall_burst=1, private_rate=1.0, private_burst=3,
+                 group_rate=20 / 60, group_burst=3, max_retries=3):
+        self.overall = TokenBucket(overall_rate, overall_burst)
+        self.private = (private_rate, private_burst)
+        self.group = (group_rate, group_burst)
+        self.max_retries = max_retries
+        self._chats = {}
+        self._pauses = 0
+        self._resume = asyncio.Event()
+        self._resume.set()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            _prune(self._chats)
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = self._chats[chat_id] = TokenBucket(*(self.group if is_group else self.private))
+        return bucket
+
+    async def _wait(self, scope, bucket):
+        delay = bucket.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        outbound_wait.observe(delay, scope)
+
+    async def _pause(self, seconds):
+        if not self._resume.is_set():
+            return
+        self._resume.clear()
+        self._pauses += 1
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            # Slots handed out before or during the pause are void; everyone
+            # queues again from an empty bucket.
+            self.overall.tokens = 0
+            self.overall.updated = time.monotonic()
+            self._resume.set()
+
+    async def _wait_overall(self):
+        while True:
+            await self._resume.wait()
+            pauses = self._pauses
+            await self._wait('overall', self.overall)
+            if pauses == self._pauses:
+                return
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        # Only requests that post into a chat count towards Telegram's limits;
+        # answers to callback and inline queries, getUpdates and the like pass.
+        limited = chat_id is not None and endpoint not in ('getChat', 'getChatMember', 'sendChatAction')
+        max_retries = rate_limit_args if isinstance(rate_limit_args, int) else self.max_retries
+
+        for attempt in range(max_retries + 1):
+            await self._resume.wait()
+            if limited:
+                await self._wait('chat', self._chat_bucket(chat_id))
+                await self._wait_overall()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                outbound_retry_after.inc(endpoint)
+                if attempt == max_retries:
+                    raise
+                logger.warning("Telegram ограничил %s, повтор через %s с", endpoint, exc.retry_after)
+                await self._pause(exc.retry_after)
+                await self._resume.wait()
+
+
+def _float(name, default):
+    return float(environ.get(name, default))
+
+
+def inbound_from_env():
+    # RATE_LIMIT_USER_RATE=0 switches the inbound limiter off.
+    if not _float("RATE_LIMIT_USER_RATE", "2"):
+        return None
+    return InboundLimiter(
+        _float("RATE_LIMIT_USER_RATE", "2"), _float("RATE_LIMIT_USER_BURST", "10"),
+        _float("RATE_LIMIT_CHAT_RATE", "5"), _float("RATE_LIMIT_CHAT_BURST", "20"),
+    )
+
+
+def outbound_from_env():
+    # RATE_LIMIT_OUTBOUND_RATE=0 switches the outbound limiter off.
+    if not _float("RATE_LIMIT_OUTBOUND_RATE", "30"):
+        return None
+    return OutboundRateLimiter(
+        overall_rate=_float("RATE_LIMIT_OUTBOUND_RATE", "30"),
+        overall_burst=_float("RATE_LIMIT_OUTBOUND_BURST", "1"),
+        private_rate=_float("RATE_LIMIT_PRIVATE_RATE", "1"),
+        private_burst=_float("RATE_LIMIT_PRIVATE_BURST", "3"),
+        group_rate=_float("RATE_LIMIT_GROUP_PER_MINUTE", "20") / 60,
+        group_burst=_float("RATE_LIMIT_GROUP_BURST", "3"),
+        max_retries=int(environ.get("RATE_LIMIT_MAX_RETRIES", "3")),
+    )
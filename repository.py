@@ -0,0 +1,599 @@
+import difflib
+import re
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import db
+import ranking
+import stats
+from cache import MISSING, TTLCache
+from writebehind import WriteBehindBuffer
+
+FREE_MONTHLY_VIEWS = 5
+CACHE_SIZE = 10000
+CACHE_TTL = 300
+WRITE_FLUSH_INTERVAL = 1.0
+WRITE_FLUSH_SIZE = 1000
+SEARCH_CANDIDATES = 50
+PENDING_UPLOAD_TTL = 3600
+ARCHIVE_LOCK = 0x7669657773
+
+# premium_users only changes through add_premium/revoke_premium, so the cached
+# premium_until is checked against the clock and stays valid until it lapses.
+premium_cache = TTLCache(CACHE_SIZE, CACHE_TTL)
+views_cache = TTLCache(CACHE_SIZE, CACHE_TTL)
+# Each user's most selected cards, by decayed score, for the top of /list.
+favorites_cache = TTLCache(CACHE_SIZE, CACHE_TTL)
+
+# Every catalog card by decayed popularity. Loaded on first use, moved by
+# selections as they happen and reloaded by the refresh job, which also
+# picks up selections made on other replicas.
+popularity = ranking.Ranking()
+
+
+class AccessContext(namedtuple('AccessContext', ['is_premium', 'monthly_views'])):
+    __slots__ = ()
+
+    @property
+    def remaining_views(self):
+        return max(FREE_MONTHLY_VIEWS - self.monthly_views, 0)
+
+    @property
+    def can_view(self):
+        return self.is_premium or self.monthly_views < FREE_MONTHLY_VIEWS
+
+
+def get_current_month_year():
+    return datetime.now().strftime("%Y-%m")
+
+
+def _parse_timestamp(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+def _is_active(premium_until):
+    # Mirrors `premium_until >= CURRENT_TIMESTAMP`, which SQLite evaluates in UTC.
+    return premium_until is not None and premium_until >= datetime.utcnow()
+
+
+async def _get_premium_until(user_id):
+    premium_until = premium_cache.get(user_id)
+    if premium_until is MISSING:
+        result = await db.fetchone('''
+            SELECT premium_until FROM premium_users WHERE user_id = ?
+        ''', (user_id,))
+        premium_until = _parse_timestamp(result[0]) if result else None
+        premium_cache.set(user_id, premium_until)
+    return premium_until
+
+
+async def has_premium_access(user_id):
+    return _is_active(await _get_premium_until(user_id))
+
+
+async def was_premium_access(user_id):
+    return await _get_premium_until(user_id) is not None
+
+
+def _utc_timestamp(moment=None):
+    return (moment or datetime.utcnow()).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _update_user_stats(cursor, user_id, now):
+    cursor.execute('SELECT last_use FROM users WHERE user_id = ?', (user_id,))
+    previous = cursor.fetchone()
+
+    if previous is None:
+        cursor.execute('''
+            INSERT INTO users (user_id, first_use, last_use) VALUES (?, ?, ?)
+        ''', (user_id, now, now))
+    else:
+        cursor.execute('''
+            UPDATE users SET last_use = ? WHERE user_id = ?
+        ''', (now, user_id))
+
+    stats.record_user_touch(cursor, previous[0] if previous else None, now)
+
+
+async def update_user_stats(user_id):
+    write_buffer.put('touch', user_id, _utc_timestamp())
+
+
+def _add_premium(cursor, user_id, premium_until):
+    cursor.execute('SELECT EXISTS(SELECT 1 FROM premium_users WHERE user_id = ?)', (user_id,))
+    existed = cursor.fetchone()[0]
+    cursor.execute('''
+        INSERT INTO premium_users (user_id, premium_until) VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET premium_until = excluded.premium_until, expiry_notified = 0
+    ''', (user_id, premium_until))
+    if not existed:
+        stats.record_premium_added(cursor)
+
+
+async def add_premium(user_id, premium_until):
+    user_id = int(user_id)
+    await db.run(_add_premium, user_id, premium_until)
+    premium_cache.set(user_id, premium_until)
+
+
+def _revoke_premium(cursor, user_id):
+    cursor.execute('DELETE FROM premium_users WHERE user_id = ?', (user_id,))
+    if cursor.rowcount:
+        stats.record_premium_removed(cursor)
+
+
+async def revoke_premium(user_id):
+    user_id = int(user_id)
+    await db.run(_revoke_premium, user_id)
+    premium_cache.set(user_id, None)
+
+
+async def get_access_context(user_id):
+    current_month = get_current_month_year()
+    premium_until = premium_cache.get(user_id)
+    views = views_cache.get((user_id, current_month))
+
+    if premium_until is MISSING or views is MISSING:
+        flushes = write_buffer.flushes if not write_buffer.flushing else None
+        row = await db.fetchone('''
+            SELECT
+                (SELECT premium_until FROM premium_users WHERE user_id = ?),
+                COALESCE((
+                    SELECT views_count FROM card_views
+                    WHERE user_id = ? AND month_year = ?
+                ), 0)
+        ''', (user_id, user_id, current_month))
+        premium_until = _parse_timestamp(row[0])
+        views = row[1] + write_buffer.pending('views', (user_id, current_month))
+        premium_cache.set(user_id, premium_until)
+        # With a flush in flight during the read there is no telling whether
+        # the row already had its batch, so that count is not cached.
+        if flushes == write_buffer.flushes and not write_buffer.flushing:
+            views_cache.set((user_id, current_month), views)
+
+    return AccessContext(_is_active(premium_until), views)
+
+
+async def increment_user_views(user_id):
+    key = (user_id, get_current_month_year())
+    write_buffer.increment('views', key)
+    # Readers add pending increments to what they load, so only a cached
+    # counter needs to move here.
+    views = views_cache.get(key)
+    if views is not MISSING:
+        views_cache.set(key, views + 1)
+
+
+def _change_blob_refcount(cursor, path, delta):
+    # Blobs are reference-counted by the cards pointing at them; paths written
+    # before content addressing have no blob row and are simply not counted.
+    cursor.execute('''
+        UPDATE blobs SET refcount = refcount + ? WHERE path = ?
+        RETURNING refcount, size
+    ''', (delta, path))
+    blob = cursor.fetchone()
+    if blob:
+        stats.record_blob_reference(cursor, blob[0], blob[1], delta)
+
+
+def _save_card(cursor, user_id, name, photo_path, file_id, barcode):
+    name_key = db.normalize_name(name)
+    cursor.execute('''
+        SELECT cards.id, cards.user_id, cards.photo
+        FROM card_catalog JOIN cards ON cards.id = card_catalog.card_id
+        WHERE card_catalog.name_key = ?
+    ''', (name_key,))
+    existing_card = cursor.fetchone()
+
+    _change_blob_refcount(cursor, photo_path, 1)
+
+    if existing_card:
+        card_id, previous_user_id, previous_photo = existing_card
+        _change_blob_refcount(cursor, previous_photo, -1)
+        cursor.execute('''
+            UPDATE cards
+            SET user_id = ?, photo = ?, file_id = ?, barcode = ?, barcode_format = ?
+            WHERE id = ?
+        ''', (user_id, photo_path, file_id, *(barcode or (None, None)), card_id))
+        stats.record_card_owner_changed(cursor, previous_user_id, user_id)
+        return None
+
+    cursor.execute('''
+        INSERT INTO cards (user_id, name, name_key, photo, file_id, barcode, barcode_format)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        RETURNING id
+    ''', (user_id, name, name_key, photo_path, file_id, *(barcode or (None, None))))
+    card_id = cursor.fetchone()[0]
+    cursor.execute('''
+        INSERT INTO card_catalog (name_key, card_id, name)
+        VALUES (?, ?, ?)
+    ''', (name_key, card_id, name))
+    stats.record_card_added(cursor, user_id)
+    return card_id
+
+
+async def save_card(user_id, name, photo_path, file_id=None, barcode=None):
+    # Returns whether a new card was created rather than an existing one updated.
+    card_id = await db.run(_save_card, user_id, name, photo_path, file_id, barcode)
+    if card_id is None:
+        return False
+    if popularity.loaded:
+        popularity.add(card_id, name)
+    return True
+
+
+def reset_caches():
+    # After a bulk change made behind the repository's back, such as an import.
+    premium_cache.clear()
+    views_cache.clear()
+    favorites_cache.clear()
+    popularity.clear()
+
+
+def _delete_card(cursor, card_name):
+    name_key = db.normalize_name(card_name)
+    cursor.execute('SELECT card_id FROM card_catalog WHERE name_key = ?', (name_key,))
+    card = cursor.fetchone()
+    if not card:
+        return None
+
+    card_id = card[0]
+    cursor.execute('DELETE FROM card_catalog WHERE card_id = ?', (card_id,))
+    cursor.execute('''
+        SELECT user_id, photo, created_at FROM cards WHERE id = ? OR name_key = ?
+    ''', (card_id, name_key))
+    for user_id, photo, created_at in cursor.fetchall():
+        _change_blob_refcount(cursor, photo, -1)
+        stats.record_card_removed(cursor, user_id, created_at)
+    # card_stats and user_card_selections rows go with their cards through
+    # ON DELETE CASCADE.
+    cursor.execute('DELETE FROM cards WHERE id = ? OR name_key = ?', (card_id, name_key))
+    return card_id
+
+
+async def delete_card(card_name):
+    card_id = await db.run(_delete_card, card_name)
+    if card_id is None:
+        return False
+    popularity.remove(card_id)
+    return True
+
+
+async def select_card(card_id, user_id=None):
+    write_buffer.increment('selections', card_id)
+    popularity.record(card_id, ranking.weight())
+    if user_id is not None:
+        write_buffer.increment('user_selections', (user_id, card_id))
+    return await get_card(card_id)
+
+
+async def get_card(card_id):
+    return await db.fetchone('''
+        SELECT name, photo, file_id, barcode, barcode_format FROM cards WHERE id = ?
+    ''', (card_id,))
+
+
+async def find_card_by_barcode(barcode):
+    return await db.fetchone('''
+        SELECT card_catalog.card_id, card_catalog.name
+        FROM cards JOIN card_catalog ON card_catalog.card_id = cards.id
+        WHERE cards.barcode = ?
+    ''', (barcode,))
+
+
+def _load_ranking(cursor):
+    # Sorted here, on the database thread, so that Ranking.load only has to
+    # confirm the order instead of sorting on the event loop.
+    cursor.execute('''
+        SELECT card_catalog.card_id, card_catalog.name, COALESCE(card_stats.popularity, 0) AS score
+        FROM card_catalog LEFT JOIN card_stats ON card_stats.card_id = card_catalog.card_id
+        ORDER BY score DESC, card_catalog.card_id
+    ''')
+    return cursor.fetchall()
+
+
+async def load_ranking():
+    popularity.load(await db.run(_load_ranking))
+
+
+async def get_ranked_page(page, page_size=10, version=None):
+    # Returns the snapshot version with the page, for the page buttons to
+    # carry; without one, or once it is gone, the current order is used.
+    if not popularity.loaded:
+        await load_ranking()
+    version = popularity.snapshot(version)
+    return version, popularity.page(page, page_size, version)
+
+
+async def get_favorite_cards(user_id, limit):
+    # The user's own most selected cards still in the catalog, best first.
+    card_ids = favorites_cache.get(user_id)
+    if card_ids is MISSING:
+        rows = await db.fetchall('''
+            SELECT card_id FROM user_card_selections
+            WHERE user_id = ?
+            ORDER BY score DESC
+            LIMIT ?
+        ''', (user_id, limit))
+        card_ids = [row[0] for row in rows]
+        favorites_cache.set(user_id, card_ids)
+    if not popularity.loaded:
+        await load_ranking()
+    return [(card_id, popularity.name(card_id)) for card_id in card_ids if card_id in popularity]
+
+
+def _fts_candidates(cursor, query, limit):
+    # A name containing every trigram of the query is found by an AND match,
+    # which stays cheap on common trigrams. Only when that leaves too few
+    # candidates is any shared trigram enough, so a typo only costs the
+    # trigrams around it; bm25 picks candidates and difflib orders them.
+    trigrams = ['"' + trigram.replace('"', '""') + '"'
+                for trigram in dict.fromkeys(query[i:i + 3] for i in range(len(query) - 2))]
+    candidates = []
+    for operator in (' AND ', ' OR '):
+        cursor.execute('''
+            SELECT card_catalog.card_id, card_catalog.name, cards.file_id
+            FROM card_search
+            JOIN card_catalog ON card_catalog.card_id = card_search.rowid
+            JOIN cards ON cards.id = card_catalog.card_id
+            WHERE card_search MATCH ?
+            ORDER BY card_search.rank
+            LIMIT ?
+        ''', (operator.join(trigrams), SEARCH_CANDIDATES))
+        candidates = cursor.fetchall()
+        if len(candidates) >= limit:
+            break
+    return candidates
+
+
+def _trigram_candidates(cursor, query):
+    # PostgreSQL has pg_trgm instead of FTS5: `<%` finds names containing a
+    # stretch similar to the query through the GIN index on the folded key,
+    # and word_similarity plays the part of bm25.
+    cursor.execute('''
+        SELECT card_catalog.card_id, card_catalog.name, cards.file_id
+        FROM card_catalog JOIN cards ON cards.id = card_catalog.card_id
+        WHERE ? <% REPLACE(card_catalog.name_key, 'ё', 'е')
+        ORDER BY word_similarity(?, REPLACE(card_catalog.name_key, 'ё', 'е')) DESC
+        LIMIT ?
+    ''', (query, query, SEARCH_CANDIDATES))
+    return cursor.fetchall()
+
+
+def _like_candidates(cursor, query):
+    # Without pg_trgm: names sharing the most trigrams with the query, which
+    # scans the catalog instead of using an index.
+    patterns = ['%' + re.sub(r'([\\%_])', r'\\\1', trigram) + '%'
+                for trigram in dict.fromkeys(query[i:i + 3] for i in range(len(query) - 2))]
+    matches = ' + '.join(["(CASE WHEN REPLACE(card_catalog.name_key, 'ё', 'е') LIKE ? THEN 1 ELSE 0 END)"]
+                         * len(patterns))
+    cursor.execute(f'''
+        SELECT card_id, name, file_id FROM (
+            SELECT card_catalog.card_id, card_catalog.name, cards.file_id, {matches} AS matches
+            FROM card_catalog JOIN cards ON cards.id = card_catalog.card_id
+        ) AS candidates
+        WHERE matches > 0
+        ORDER BY matches DESC
+        LIMIT ?
+    ''', (*patterns, SEARCH_CANDIDATES))
+    return cursor.fetchall()
+
+
+def _search_cards(cursor, query, limit):
+    if len(query) < 3:
+        # Too short for trigrams: a prefix range over the catalog key, folded
+        # like the query so "ел" finds "Ёлки".
+        cursor.execute('''
+            SELECT card_catalog.card_id, card_catalog.name, cards.file_id
+            FROM card_catalog JOIN cards ON cards.id = card_catalog.card_id
+            WHERE REPLACE(card_catalog.name_key, 'ё', 'е') >= ?
+              AND REPLACE(card_catalog.name_key, 'ё', 'е') < ?
+            ORDER BY REPLACE(card_catalog.name_key, 'ё', 'е')
+            LIMIT ?
+        ''', (query, query + '\uffff', limit))
+        return cursor.fetchall()
+
+    if db.DIALECT == 'postgres':
+        import postgres
+        candidates = (_trigram_candidates if postgres.has_trigram(cursor) else _like_candidates)(cursor, query)
+    else:
+        candidates = _fts_candidates(cursor, query, limit)
+
+    def score(card):
+        name = db.normalize_search(card[1])
+        similarity = difflib.SequenceMatcher(None, query, name).ratio()
+        if name.startswith(query):
+            similarity += 1
+        elif query in name:
+            similarity += 0.5
+        return similarity
+
+    candidates.sort(key=score, reverse=True)
+    return candidates[:limit]
+
+
+async def search_cards(query, limit=10):
+    query = db.normalize_search(query)
+    if not query:
+        return []
+    return await db.run(_search_cards, query, limit)
+
+
+async def register_blob(sha256, path, size):
+    # created_at is refreshed on every upload, so a blob that is only held by
+    # a pending upload is not collected while that upload is still fresh.
+    await db.execute('''
+        INSERT INTO blobs (sha256, path, size) VALUES (?, ?, ?)
+        ON CONFLICT(sha256) DO UPDATE SET created_at = CURRENT_TIMESTAMP
+    ''', (sha256, path, size))
+
+
+async def delete_orphan_blobs():
+    # Blobs no card points at, uploaded longer ago than a pending upload may
+    # live, and not held by any pending upload. Returns their paths so the
+    # files can be removed from storage.
+    rows = await db.fetchall('''
+        DELETE FROM blobs
+        WHERE refcount = 0
+            AND created_at < ?
+            AND path NOT IN (SELECT photo FROM pending_uploads)
+        RETURNING path
+    ''', (_utc_timestamp(datetime.utcnow() - timedelta(seconds=PENDING_UPLOAD_TTL)),))
+    return [row[0] for row in rows]
+
+
+async def set_pending_upload(user_id, photo_path, file_id, barcode):
+    # Kept in the database rather than in user_data, so the name can arrive
+    # at any replica; a newer photo replaces the one waiting.
+    await db.execute('''
+        INSERT INTO pending_uploads (user_id, photo, file_id, barcode, barcode_format, uploaded_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            photo = excluded.photo, file_id = excluded.file_id, barcode = excluded.barcode,
+            barcode_format = excluded.barcode_format, uploaded_at = excluded.uploaded_at
+    ''', (user_id, photo_path, file_id, *(barcode or (None, None)), time.time()))
+
+
+async def take_pending_upload(user_id):
+    # Removes the user's pending upload and returns (photo, file_id, barcode),
+    # or None when there is none or it has expired. Taking it in one
+    # statement means two names racing for one photo cannot both get it.
+    row = await db.fetchone('''
+        DELETE FROM pending_uploads WHERE user_id = ?
+        RETURNING photo, file_id, barcode, barcode_format, uploaded_at
+    ''', (user_id,))
+    if not row or row[4] < time.time() - PENDING_UPLOAD_TTL:
+        return None
+    photo, file_id, barcode, barcode_format, _ = row
+    return photo, file_id, (barcode, barcode_format) if barcode else None
+
+
+async def delete_expired_uploads():
+    return await db.execute('''
+        DELETE FROM pending_uploads WHERE uploaded_at < ?
+    ''', (time.time() - PENDING_UPLOAD_TTL,))
+
+
+async def claim_expired_premium(limit):
+    # Marks up to `limit` lapsed subscriptions as notified and returns their
+    # users. The outer expiry_notified check is evaluated again on rows
+    # another replica has just claimed, so each user is returned only once.
+    rows = await db.fetchall('''
+        UPDATE premium_users SET expiry_notified = 1
+        WHERE expiry_notified = 0 AND user_id IN (
+            SELECT user_id FROM premium_users
+            WHERE premium_until < CURRENT_TIMESTAMP AND expiry_notified = 0
+            ORDER BY premium_until
+            LIMIT ?
+        )
+        RETURNING user_id
+    ''', (limit,))
+    return [row[0] for row in rows]
+
+
+def _archive_card_views(cursor, keep_from):
+    if db.DIALECT == 'postgres':
+        # Two replicas archiving at once would both count the same rows.
+        cursor.execute('SELECT pg_advisory_xact_lock(?)', (ARCHIVE_LOCK,))
+    cursor.execute('''
+        INSERT INTO card_views_archive (month_year, users, views)
+        SELECT month_year, COUNT(*), SUM(views_count) FROM card_views
+        WHERE month_year < ?
+        GROUP BY month_year
+        ON CONFLICT(month_year) DO UPDATE SET
+            users = card_views_archive.users + excluded.users,
+            views = card_views_archive.views + excluded.views
+    ''', (keep_from,))
+    archived = cursor.rowcount
+    cursor.execute('DELETE FROM card_views WHERE month_year < ?', (keep_from,))
+    return archived
+
+
+async def archive_card_views(keep_from):
+    return await db.run(_archive_card_views, keep_from)
+
+
+async def load_conversation_data(kind):
+    rows = await db.fetchall('SELECT id, data FROM conversation_data WHERE kind = ?', (kind,))
+    return dict(rows)
+
+
+async def set_card_file_id(card_id, file_id):
+    await db.execute('UPDATE cards SET file_id = ? WHERE id = ?', (file_id, card_id))
+
+
+async def get_cards_without_file_id(after=0, limit=100):
+    return await db.fetchall('''
+        SELECT id, photo FROM cards
+        WHERE file_id IS NULL AND id > ?
+        ORDER BY id
+        LIMIT ?
+    ''', (after, limit))
+
+
+async def collect_stats():
+    return await db.run(stats.snapshot)
+
+
+def cache_stats():
+    return {
+        'premium': premium_cache.stats(),
+        'views': views_cache.stats(),
+        'favorites': favorites_cache.stats(),
+    }
+
+
+def _flush_writes(cursor, pending):
+    cursor.executemany('''
+        INSERT INTO card_views (user_id, month_year, views_count)
+        VALUES (?, ?, ?)
+        ON CONFLICT(user_id, month_year)
+        DO UPDATE SET views_count = card_views.views_count + excluded.views_count
+    ''', ((user_id, month, count) for (user_id, month), count in pending.get('views', {}).items()))
+
+    # Selections pending since the last flush are scored as made now.
+    weight = ranking.weight()
+    cursor.executemany('''
+        INSERT INTO card_stats (card_id, selection_count, popularity)
+        SELECT ?, ?, ? WHERE EXISTS(SELECT 1 FROM cards WHERE id = ?)
+        ON CONFLICT(card_id) DO UPDATE SET
+            selection_count = card_stats.selection_count + excluded.selection_count,
+            popularity = card_stats.popularity + excluded.popularity
+    ''', ((card_id, count, count * weight, card_id) for card_id, count in pending.get('selections', {}).items()))
+    cursor.executemany('''
+        INSERT INTO user_card_selections (user_id, card_id, score)
+        SELECT ?, ?, ? WHERE EXISTS(SELECT 1 FROM cards WHERE id = ?)
+        ON CONFLICT(user_id, card_id) DO UPDATE SET score = user_card_selections.score + excluded.score
+    ''', ((user_id, card_id, count * weight, card_id)
+          for (user_id, card_id), count in pending.get('user_selections', {}).items()))
+
+    for user_id, now in pending.get('touch', {}).items():
+        _update_user_stats(cursor, user_id, now)
+
+    for kind in ('user_data', 'chat_data'):
+        rows = pending.get(kind, {})
+        cursor.executemany('''
+            DELETE FROM conversation_data WHERE kind = ? AND id = ?
+        ''', ((kind, key) for key, data in rows.items() if data is None))
+        cursor.executemany('''
+            INSERT INTO conversation_data (kind, id, data) VALUES (?, ?, ?)
+            ON CONFLICT(kind, id) DO UPDATE SET data = excluded.data, updated_at = CURRENT_TIMESTAMP
+        ''', ((kind, key, data) for key, data in rows.items() if data is not None))
+
+
+async def _flush_writes_async(pending):
+    await db.run(_flush_writes, pending)
+    # Favorites read before the flush did not include these selections.
+    for user_id, _ in pending.get('user_selections', {}):
+        favorites_cache.invalidate(user_id)
+
+
+write_buffer = WriteBehindBuffer(
+    _flush_writes_async,
+    counters=('views', 'selections', 'user_selections'),
+    interval=WRITE_FLUSH_INTERVAL,
+    max_pending=WRITE_FLUSH_SIZE,
+)
@@ -0,0 +1,283 @@
+import sys
+from datetime import datetime, timedelta
+
+import db
+
+COUNTERS = (
+    'total_users',
+    'total_cards',
+    'users_with_cards',
+    'premium_users',
+    'usage_days',
+    'storage_used',
+    'storage_saved',
+)
+DAILY_COLUMNS = ('new_users', 'new_cards', 'last_seen_users')
+
+
+def create_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    # last_seen_users is a histogram of users.last_use by day: a user moves to
+    # today's bucket on every touch, so the last N buckets hold the number of
+    # distinct users active in the last N days.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT PRIMARY KEY,
+            new_users INTEGER NOT NULL DEFAULT 0,
+            new_cards INTEGER NOT NULL DEFAULT 0,
+            last_seen_users INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_card_counts (
+            user_id INTEGER PRIMARY KEY,
+            cards INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_card_stats_selection_count ON card_stats (selection_count)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_premium_users_premium_until ON premium_users (premium_until)')
+
+    cursor.execute('SELECT EXISTS(SELECT 1 FROM stats_counters)')
+    if not cursor.fetchone()[0]:
+        rebuild(cursor)
+
+
+def _add(cursor, name, delta):
+    cursor.execute('''
+        INSERT INTO stats_counters (name, value) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = stats_counters.value + excluded.value
+    ''', (name, delta))
+
+
+def _parse(timestamp):
+    return timestamp if isinstance(timestamp, datetime) else datetime.fromisoformat(timestamp)
+
+
+def _day(timestamp):
+    # The UTC calendar day of a stored timestamp, or of 'now', as an ISO date.
+    if timestamp is None:
+        return None
+    if timestamp == 'now':
+        return datetime.utcnow().date().isoformat()
+    return _parse(timestamp).date().isoformat()
+
+
+def _add_daily(cursor, timestamp, column, delta):
+    cursor.execute(f'''
+        INSERT INTO stats_daily (day, {column}) VALUES (?, ?)
+        ON CONFLICT(day) DO UPDATE SET {column} = stats_daily.{column} + excluded.{column}
+    ''', (_day(timestamp), delta))
+
+
+def _add_user_cards(cursor, user_id, delta):
+    cursor.execute('''
+        INSERT INTO user_card_counts (user_id, cards) VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET cards = user_card_counts.cards + excluded.cards
+        RETURNING cards
+    ''', (user_id, delta))
+    cards = cursor.fetchone()[0]
+    if delta > 0 and cards == delta:
+        _add(cursor, 'users_with_cards', 1)
+    elif cards <= 0:
+        cursor.execute('DELETE FROM user_card_counts WHERE user_id = ?', (user_id,))
+        _add(cursor, 'users_with_cards', -1)
+
+
+def record_user_touch(cursor, previous_last_use, now):
+    if previous_last_use is None:
+        _add(cursor, 'total_users', 1)
+        _add_daily(cursor, now, 'new_users', 1)
+        _add_daily(cursor, now, 'last_seen_users', 1)
+        return
+
+    now, previous_last_use = _parse(now), _parse(previous_last_use)
+    _add(cursor, 'usage_days', (now - previous_last_use).total_seconds() / 86400)
+    if now.date() != previous_last_use.date():
+        _add_daily(cursor, previous_last_use, 'last_seen_users', -1)
+        _add_daily(cursor, now, 'last_seen_users', 1)
+
+
+def record_card_added(cursor, user_id, created_at='now'):
+    _add(cursor, 'total_cards', 1)
+    _add_daily(cursor, created_at, 'new_cards', 1)
+    _add_user_cards(cursor, user_id, 1)
+
+
+def record_card_removed(cursor, user_id, created_at):
+    _add(cursor, 'total_cards', -1)
+    _add_daily(cursor, created_at, 'new_cards', -1)
+    _add_user_cards(cursor, user_id, -1)
+
+
+def record_card_owner_changed(cursor, previous_user_id, user_id):
+    if previous_user_id != user_id:
+        _add_user_cards(cursor, previous_user_id, -1)
+        _add_user_cards(cursor, user_id, 1)
+
+
+def record_premium_added(cursor):
+    _add(cursor, 'premium_users', 1)
+
+
+def record_premium_removed(cursor):
+    _add(cursor, 'premium_users', -1)
+
+
+def record_blob_reference(cursor, refcount, size, delta):
+    # A blob counts towards storage_used while referenced; every reference
+    # beyond the first is space deduplication saved.
+    if delta > 0:
+        _add(cursor, 'storage_used' if refcount == 1 else 'storage_saved', size)
+    elif refcount == 0:
+        _add(cursor, 'storage_used', -size)
+    elif refcount > 0:
+        _add(cursor, 'storage_saved', -size)
+
+
+def snapshot(cursor):
+    cursor.execute('SELECT name, value FROM stats_counters')
+    counters = dict.fromkeys(COUNTERS, 0)
+    counters.update(cursor.fetchall())
+
+    cursor.execute('''
+        SELECT COALESCE(SUM(new_users), 0), COALESCE(SUM(new_cards), 0), COALESCE(SUM(last_seen_users), 0)
+        FROM stats_daily WHERE day >= ?
+    ''', ((datetime.utcnow().date() - timedelta(days=7)).isoformat(),))
+    new_users, new_cards, active_users = map(int, cursor.fetchone())
+
+    cursor.execute('''
+        SELECT c.name, cs.selection_count
+        FROM card_stats cs
+        JOIN cards c ON c.id = cs.card_id
+        ORDER BY cs.selection_count DESC
+        LIMIT 5
+    ''')
+    top_cards = cursor.fetchall()
+
+    cursor.execute('SELECT COUNT(*) FROM premium_users WHERE premium_until >= CURRENT_TIMESTAMP')
+    active_premium_users = cursor.fetchone()[0]
+
+    total_users = int(counters['total_users'])
+    total_cards = int(counters['total_cards'])
+    users_with_cards = int(counters['users_with_cards'])
+    premium_users = int(counters['premium_users'])
+    avg_cards_per_user = total_cards / users_with_cards if users_with_cards > 0 else 0
+
+    return {
+        'total_users': total_users,
+        'users_with_cards': users_with_cards,
+        'total_cards': total_cards,
+        'avg_cards_per_user': avg_cards_per_user,
+        'retention_rate': (active_users / total_users) * 100 if total_users > 0 else 0,
+        'active_users_last_7_days': active_users,
+        'new_users_last_7_days': new_users,
+        'conversion_rate': (users_with_cards / total_users) * 100 if total_users > 0 else 0,
+        'avg_usage_duration': counters['usage_days'] / total_users if total_users > 0 else 0,
+        'top_cards': top_cards,
+        'cards_last_7_days': new_cards,
+        'avg_cards_per_active_user': avg_cards_per_user,
+        'premium_users': premium_users,
+        'premium_conversion': (premium_users / total_users) * 100 if total_users > 0 else 0,
+        'active_premium_users': active_premium_users,
+        'storage_used': counters['storage_used'],
+        'storage_saved': counters['storage_saved'],
+    }
+
+
+def _compute(cursor):
+    counters = {}
+    cursor.execute(f'''
+        SELECT COUNT(*), COALESCE(SUM({db.days_between('last_use', 'first_use')}), 0) FROM users
+    ''')
+    total_users, usage_days = cursor.fetchone()
+    counters['total_users'], counters['usage_days'] = total_users, float(usage_days)
+    cursor.execute('SELECT COUNT(*) FROM cards')
+    counters['total_cards'] = cursor.fetchone()[0]
+    cursor.execute('SELECT COUNT(*) FROM premium_users')
+    counters['premium_users'] = cursor.fetchone()[0]
+    cursor.execute('''
+        SELECT COALESCE(SUM(size), 0), COALESCE(SUM((refcount - 1) * size), 0)
+        FROM blobs WHERE refcount > 0
+    ''')
+    counters['storage_used'], counters['storage_saved'] = map(float, cursor.fetchone())
+
+    cursor.execute('SELECT user_id, COUNT(*) FROM cards GROUP BY user_id')
+    user_cards = dict(cursor.fetchall())
+    counters['users_with_cards'] = len(user_cards)
+
+    daily = {}
+    for column, table, timestamp in (
+        ('new_users', 'users', 'first_use'),
+        ('new_cards', 'cards', 'created_at'),
+        ('last_seen_users', 'users', 'last_use'),
+    ):
+        for day, count in cursor.execute(f'SELECT {db.date_of(timestamp)}, COUNT(*) FROM {table} GROUP BY 1'):
+            daily.setdefault(str(day), dict.fromkeys(DAILY_COLUMNS, 0))[column] = count
+
+    return counters, daily, user_cards
+
+
+def rebuild(cursor):
+    counters, daily, user_cards = _compute(cursor)
+
+    cursor.execute('DELETE FROM stats_counters')
+    cursor.executemany('INSERT INTO stats_counters (name, value) VALUES (?, ?)', counters.items())
+    cursor.execute('DELETE FROM stats_daily')
+    cursor.executemany(
+        'INSERT INTO stats_daily (day, new_users, new_cards, last_seen_users) VALUES (?, ?, ?, ?)',
+        ((day, *(values[column] for column in DAILY_COLUMNS)) for day, values in daily.items())
+    )
+    cursor.execute('DELETE FROM user_card_counts')
+    cursor.executemany('INSERT INTO user_card_counts (user_id, cards) VALUES (?, ?)', user_cards.items())
+
+
+def check(cursor):
+    counters, daily, user_cards = _compute(cursor)
+    differences = []
+
+    cursor.execute('SELECT name, value FROM stats_counters')
+    stored_counters = dict(cursor.fetchall())
+    for name in COUNTERS:
+        stored = stored_counters.get(name, 0)
+        if abs(stored - counters[name]) > 1e-6:
+            differences.append(f"{name}: {stored} != {counters[name]}")
+
+    cursor.execute(f"SELECT day, {', '.join(DAILY_COLUMNS)} FROM stats_daily")
+    stored_daily = {row[0]: dict(zip(DAILY_COLUMNS, row[1:])) for row in cursor.fetchall()}
+    for day in sorted(set(daily) | set(stored_daily)):
+        expected = daily.get(day, dict.fromkeys(DAILY_COLUMNS, 0))
+        stored = stored_daily.get(day, dict.fromkeys(DAILY_COLUMNS, 0))
+        for column in DAILY_COLUMNS:
+            if stored[column] != expected[column]:
+                differences.append(f"{day} {column}: {stored[column]} != {expected[column]}")
+
+    cursor.execute('SELECT user_id, cards FROM user_card_counts')
+    stored_user_cards = dict(cursor.fetchall())
+    for user_id in set(user_cards) | set(stored_user_cards):
+        if stored_user_cards.get(user_id, 0) != user_cards.get(user_id, 0):
+            differences.append(
+                f"user {user_id} cards: {stored_user_cards.get(user_id, 0)} != {user_cards.get(user_id, 0)}"
+            )
+
+    return differences
+
+
+if __name__ == '__main__':
+    db.create_database()
+    if sys.argv[1:] == ['rebuild']:
+        db.run_sync(rebuild)
+        print("Статистика пересчитана.")
+    elif sys.argv[1:] in ([], ['check']):
+        differences = db.run_sync(check)
+        for difference in differences:
+            print(difference)
+        print(f"Расхождений: {len(differences)}")
+        sys.exit(1 if differences else 0)
+    else:
+        sys.exit("Использование: python stats.py [check|rebuild]")
+    db.close()
@@ -0,0 +1,295 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import sys
+import tempfile
+from datetime import datetime
+from os import environ
+from urllib.parse import quote, urlparse
+
+import httpx
+
+import images
+
+PHOTOS_DIR = "photos"
+CHUNK_SIZE = 64 * 1024
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+
+_client = None
+_backend = None
+
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(timeout=30)
+    return _client
+
+
+def photo_key(sha256):
+    return f"{PHOTOS_DIR}/{sha256}.jpg"
+
+
+class LocalStorage:
+    def __init__(self, root="."):
+        self.root = root
+        self.spool_dir = os.path.join(root, PHOTOS_DIR)
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    async def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    async def put_file(self, key, source_path, sha256):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(source_path, path)
+
+    async def stream(self, key):
+        with open(self._path(key), 'rb') as source:
+            while chunk := await asyncio.to_thread(source.read, CHUNK_SIZE):
+                yield chunk
+
+    async def delete(self, key):
+        if os.path.exists(self._path(key)):
+            os.remove(self._path(key))
+
+
+class S3Storage:
+    # Path-style requests signed with AWS Signature V4, which is what MinIO and
+    # other S3-compatible servers accept.
+    def __init__(self, endpoint, bucket, access_key, secret_key, region="us-east-1"):
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.spool_dir = None
+
+    def _request(self, method, key, payload_hash=EMPTY_SHA256):
+        path = quote(f"/{self.bucket}/{key}", safe="/~")
+        now = datetime.utcnow()
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        scope = f"{now:%Y%m%d}/{self.region}/s3/aws4_request"
+
+        headers = {
+            "host": urlparse(self.endpoint).netloc,
+            "x-amz-content-sha256": payload_hash,
+            "x-amz-date": amz_date,
+        }
+        signed_headers = ";".join(sorted(headers))
+        canonical_request = "\n".join([
+            method,
+            path,
+            "",
+            "".join(f"{name}:{headers[name]}\n" for name in sorted(headers)),
+            signed_headers,
+            payload_hash,
+        ])
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode()).hexdigest(),
+        ])
+
+        signing_key = f"AWS4{self.secret_key}".encode()
+        for part in (f"{now:%Y%m%d}", self.region, "s3", "aws4_request"):
+            signing_key = hmac.new(signing_key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+        headers["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={signed_headers}, Signature={signature}"
+        )
+        return f"{self.endpoint}{path}", headers
+
+    async def exists(self, key):
+        url, headers = self._request("HEAD", key)
+        response = await _get_client().head(url, headers=headers)
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        return True
+
+    async def put_file(self, key, source_path, sha256):
+        async def body():
+            with open(source_path, 'rb') as source:
+                while chunk := await asyncio.to_thread(source.read, CHUNK_SIZE):
+                    yield chunk
+
+        url, headers = self._request("PUT", key, sha256)
+        headers["content-length"] = str(os.path.getsize(source_path))
+        headers["content-type"] = "image/jpeg"
+        response = await _get_client().put(url, headers=headers, content=body())
+        response.raise_for_status()
+        os.remove(source_path)
+
+    async def stream(self, key):
+        url, headers = self._request("GET", key)
+        async with _get_client().stream("GET", url, headers=headers) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                yield chunk
+
+    async def delete(self, key):
+        url, headers = self._request("DELETE", key)
+        response = await _get_client().delete(url, headers=headers)
+        if response.status_code != 404:
+            response.raise_for_status()
+
+
+def create_backend(name):
+    if name == "local":
+        return LocalStorage(environ.get("PHOTOS_ROOT", "."))
+    if name == "s3":
+        return S3Storage(
+            environ["S3_ENDPOINT"],
+            environ["S3_BUCKET"],
+            environ["S3_ACCESS_KEY"],
+            environ["S3_SECRET_KEY"],
+            environ.get("S3_REGION", "us-east-1"),
+        )
+    raise ValueError(f"Неизвестное хранилище: {name}")
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = create_backend(environ.get("STORAGE_BACKEND", "local"))
+    return _backend
+
+
+async def download(file_path):
+    if not file_path.startswith(("http://", "https://")):
+        # Local Bot API servers hand out paths on the same host.
+        async for chunk in LocalStorage("").stream(file_path):
+            yield chunk
+        return
+
+    async with _get_client().stream("GET", file_path) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(CHUNK_SIZE):
+            yield chunk
+
+
+async def _store(backend, chunks, normalize=False, decode=False):
+    # Blobs are content-addressed: the stream is hashed while it is spooled to
+    # a temp file, which is handed to the backend as <sha256>.jpg unless that
+    # blob is already stored. Normalized photos are hashed after conversion,
+    # by the worker process that wrote them.
+    if backend.spool_dir:
+        os.makedirs(backend.spool_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+
+    fd, temp_path = tempfile.mkstemp(dir=backend.spool_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            async for chunk in chunks:
+                if not normalize:
+                    digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+
+        if normalize:
+            source_path = temp_path
+            fd, temp_path = tempfile.mkstemp(dir=backend.spool_dir, suffix=".part")
+            os.close(fd)
+            try:
+                sha256, size, barcode = await images.normalize(source_path, temp_path)
+            finally:
+                os.remove(source_path)
+        else:
+            sha256 = digest.hexdigest()
+            barcode = await images.decode(temp_path) if decode else None
+
+        key = photo_key(sha256)
+        if await backend.exists(key):
+            os.remove(temp_path)
+        else:
+            await backend.put_file(key, temp_path, sha256)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return sha256, key, size, barcode
+
+
+def normalizes_photos():
+    return environ.get("IMAGE_NORMALIZE", "1") == "1"
+
+
+async def store_photo(photo_file):
+    return await _store(get_backend(), download(photo_file.file_path), normalizes_photos(), decode=True)
+
+
+async def read_photo(key):
+    return b"".join([chunk async for chunk in get_backend().stream(key)])
+
+
+async def photo_exists(key):
+    return await get_backend().exists(key)
+
+
+async def delete_photo(key):
+    await get_backend().delete(key)
+
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def migrate(source, target, batch_size=100):
+    import db
+    import stats
+
+    db.create_database()
+    moved = 0
+    missing = 0
+    last_id = 0
+    while True:
+        cards = await db.fetchall('''
+            SELECT id, photo FROM cards
+            WHERE id > ? AND photo IS NOT NULL
+            ORDER BY id
+            LIMIT ?
+        ''', (last_id, batch_size))
+        if not cards:
+            break
+
+        for card_id, photo in cards:
+            last_id = card_id
+            if not await source.exists(photo):
+                missing += 1
+                continue
+
+            sha256, key, size, _ = await _store(target, source.stream(photo))
+            await db.execute('''
+                INSERT INTO blobs (sha256, path, size) VALUES (?, ?, ?)
+                ON CONFLICT DO NOTHING
+            ''', (sha256, key, size))
+            await db.execute('UPDATE cards SET photo = ? WHERE id = ?', (key, card_id))
+            moved += 1
+
+    await db.execute('''
+        UPDATE blobs SET refcount = (SELECT COUNT(*) FROM cards WHERE cards.photo = blobs.path)
+    ''')
+    await db.run(stats.rebuild)
+    await close()
+    db.close()
+    return moved, missing
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != "migrate":
+        sys.exit("Использование: python storage.py migrate <local|s3> <local|s3>")
+
+    moved, missing = asyncio.run(migrate(create_backend(sys.argv[2]), create_backend(sys.argv[3])))
+    print(f"Перенесено карт: {moved}. Файлы не найдены: {missing}.")
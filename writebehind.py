@@ -0,0 +1,114 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    # Coalesces hot writes in memory and hands them to `flush` in one batch,
+    # either every `interval` seconds or once `max_pending` keys are waiting.
+    # Counter kinds are summed per key; every other kind keeps the last value.
+    def __init__(self, flush, counters=(), interval=1.0, max_pending=1000):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.flushes = 0
+        self.flushed_keys = 0
+        self._flush = flush
+        self._counters = set(counters)
+        self._pending = {}
+        self._flushing = {}
+        self._size = 0
+        self._lock = None
+        self._task = None
+        self._size_flush = None
+
+    def increment(self, kind, key, delta=1):
+        bucket = self._pending.setdefault(kind, {})
+        if key not in bucket:
+            self._size += 1
+        bucket[key] = bucket.get(key, 0) + delta
+        self._flush_if_full()
+
+    def put(self, kind, key, value):
+        bucket = self._pending.setdefault(kind, {})
+        if key not in bucket:
+            self._size += 1
+        bucket[key] = value
+        self._flush_if_full()
+
+    def pending(self, kind, key, default=0):
+        # The batch being flushed counts until `flush` returns: a read racing
+        # the flush may not see its commit yet.
+        bucket = self._pending.get(kind, {})
+        in_flight = self._flushing.get(kind, {})
+        if key not in bucket and key not in in_flight:
+            return default
+        if kind in self._counters:
+            return bucket.get(key, 0) + in_flight.get(key, 0)
+        return bucket[key] if key in bucket else in_flight[key]
+
+    @property
+    def flushing(self):
+        return bool(self._flushing)
+
+    def __len__(self):
+        return self._size
+
+    def _flush_if_full(self):
+        if self._size >= self.max_pending and (self._size_flush is None or self._size_flush.done()):
+            self._size_flush = asyncio.get_running_loop().create_task(self.flush())
+
+    def _restore(self, pending):
+        for kind, bucket in pending.items():
+            for key, value in bucket.items():
+                if kind in self._counters:
+                    self.increment(kind, key, value)
+                elif key not in self._pending.get(kind, {}):
+                    self.put(kind, key, value)
+
+    async def flush(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self._pending:
+                return
+            pending, size = self._pending, self._size
+            self._pending, self._size = {}, 0
+            self._flushing = pending
+            try:
+                await self._flush(pending)
+            except BaseException:
+                self._restore(pending)
+                raise
+            finally:
+                self._flushing = {}
+            self.flushes += 1
+            self.flushed_keys += size
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Не удалось записать отложенные изменения")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            # Cancelled only between flushes: a flush cancelled while its
+            # batch is being committed would restore the batch and write it
+            # again below.
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()